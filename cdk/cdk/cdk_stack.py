@@ -5,6 +5,7 @@ from aws_cdk import (
     aws_ecr_assets as ECRAssets,
     aws_dynamodb as DynamoDB,
     aws_lambda as LAMBDA,
+    aws_lambda_event_sources as LambdaEventSources,
     aws_iam as IAM,
     aws_ec2 as EC2,
     aws_ecs as ECS,
@@ -13,10 +14,12 @@ from aws_cdk import (
     aws_sns_subscriptions as sns_subscriptions,
     aws_s3 as S3,
     aws_apigateway as APIGateway,
+    aws_events as Events,
+    aws_events_targets as EventsTargets,
     aws_logs as logs
 )
 
-from aws_cdk import RemovalPolicy, Duration
+from aws_cdk import RemovalPolicy, Duration, Size
 from aws_cdk import aws_s3_deployment as S3Deploy
 from constructs import Construct
 
@@ -46,6 +49,36 @@ class CdkStack(Stack):
             time_to_live_attribute = "ttl"
         )
 
+        # Create crawl state table, where the scraper saves the checkpoint of each keyword
+        self.crawl_state_table = DynamoDB.TableV2(
+            self,
+            "CrawlStateTable",
+            partition_key = DynamoDB.Attribute(name="Keyword", type=DynamoDB.AttributeType.STRING),
+            billing = DynamoDB.Billing.on_demand(),
+            removal_policy = RemovalPolicy.DESTROY,
+            time_to_live_attribute = "ttl"
+        )
+
+        # Create job index table, with the S3 key of the preprocessed and labeled version of each job
+        self.job_index_table = DynamoDB.TableV2(
+            self,
+            "JobIndexTable",
+            partition_key = DynamoDB.Attribute(name="Job_ID", type=DynamoDB.AttributeType.STRING),
+            sort_key = DynamoDB.Attribute(name="Kind", type=DynamoDB.AttributeType.STRING),
+            billing = DynamoDB.Billing.on_demand(),
+            removal_policy = RemovalPolicy.DESTROY
+        )
+
+        # Create job leases table, with the receipt handle of each job checked out by an annotator
+        self.job_leases_table = DynamoDB.TableV2(
+            self,
+            "JobLeasesTable",
+            partition_key = DynamoDB.Attribute(name="Job_ID", type=DynamoDB.AttributeType.STRING),
+            billing = DynamoDB.Billing.on_demand(),
+            removal_policy = RemovalPolicy.DESTROY,
+            time_to_live_attribute = "ttl"
+        )
+
 
 
         # ===== SQS QUEUES =====
@@ -61,21 +94,36 @@ class CdkStack(Stack):
             )
         )
 
-        # Create job posts queue for deduplicated posts
+        # Create job posts queue for deduplicated posts.
+        # Visibility timeout is 6 times the preprocessing lambda timeout, as recommended for event source mappings
         self.deduplicated_posts_queue = SQS.Queue(
             self,
             "DeduplicatedJobPostsQueue",
-            visibility_timeout = Duration.seconds(180),
+            visibility_timeout = Duration.seconds(1080),
             retention_period = Duration.days(14),
             dead_letter_queue = self.dead_letter_queue
         )
 
-        # Create preprocessed job posts queue
+        # Create preprocessed job posts queue. Every checkout of a job by the web page is a receive, and so is
+        # every lease released or expired, so its messages go to the dead letter queue after many more receives
         self.preprocessed_job_posts_queue = SQS.Queue(
             self,
             "PreprocessedJobPostsQueue",
             visibility_timeout = Duration.seconds(180),
             retention_period = Duration.days(14),
+            dead_letter_queue = SQS.DeadLetterQueue(
+                max_receive_count = 100,
+                queue = self.dead_letter_queue.queue
+            )
+        )
+
+        # Create queue buffering the preprocessed job posts to archive in the s3 bucket.
+        # Visibility timeout is 6 times the archiving lambda timeout, as recommended for event source mappings
+        self.preprocessed_posts_archive_queue = SQS.Queue(
+            self,
+            "PreprocessedPostsArchiveQueue",
+            visibility_timeout = Duration.seconds(360),
+            retention_period = Duration.days(14),
             dead_letter_queue = self.dead_letter_queue
         )
 
@@ -103,6 +151,7 @@ class CdkStack(Stack):
         
         # Grant permissions to access DynamoDB table
         self.job_posts_table.grant_read_write_data(task_role)
+        self.crawl_state_table.grant_read_write_data(task_role)
 
         # Grant permissions to access SQS queues
         self.deduplicated_posts_queue.grant_send_messages(task_role)
@@ -166,9 +215,20 @@ class CdkStack(Stack):
             environment = {
                 "AWS_DEFAULT_REGION": self.region,
                 "DYNAMODB_TABLE_NAME": self.job_posts_table.table_name,
+                "CRAWL_STATE_TABLE_NAME": self.crawl_state_table.table_name,
                 "DEDUPLICATED_JOBS_QUEUE_NAME": self.deduplicated_posts_queue.queue_name,
                 "DEAD_LETTER_QUEUE_NAME": self.dead_letter_queue.queue.queue_name,
-                "SINGLE_JOB_BASE_LINK": "https://www.linkedin.com/jobs-guest/jobs/api/jobPosting/"
+                "SINGLE_JOB_BASE_LINK": "https://www.linkedin.com/jobs-guest/jobs/api/jobPosting/",
+                "MAX_IN_FLIGHT_REQUESTS": "4",
+                # Request rate of the whole task, split among its worker processes
+                "REQUESTS_PER_SECOND_PER_HOST": "2",
+                "WORKER_PROCESSES": "2",
+                "CRAWL_LEASE_SECONDS": "300",
+                # Stable across restarts, so a restarted task resumes the keywords of the stopped one.
+                # Tasks running on the same shard need a different WORKER_ID each
+                "SHARD_INDEX": "0",
+                "SHARD_COUNT": "1",
+                "WORKER_ID": "scraper-shard-0"
             }
         )
 
@@ -212,6 +272,10 @@ class CdkStack(Stack):
             removal_policy = RemovalPolicy.DESTROY,
             auto_delete_objects = True,
             block_public_access = S3.BlockPublicAccess.BLOCK_ALL,
+            lifecycle_rules = [
+                # Claim-check objects are needed only while their message can still be in a queue
+                S3.LifecycleRule(prefix="Claim-check/", expiration=Duration.days(15))
+            ]
         )
 
 
@@ -268,11 +332,24 @@ class CdkStack(Stack):
             function_name = "ConteinerizedPreprocessingJobPosts",
             environment = {
                 "DEDUPLICATED_JOBS_QUEUE_NAME": self.deduplicated_posts_queue.queue_name,
-                "SNS_TOPIC_ARN": self.sns_topic.topic_arn
+                "SNS_TOPIC_ARN": self.sns_topic.topic_arn,
+                "S3_BUCKET_NAME": self.s3_bucket.bucket_name,
+                "CLAIM_CHECK_THRESHOLD_BYTES": "200000"
             }
         )
         self.deduplicated_posts_queue.grant_consume_messages(preprocessing_lambda)
         self.sns_topic.grant_publish(preprocessing_lambda)
+        self.s3_bucket.grant_read_write(preprocessing_lambda)
+
+        # Invoke the preprocessing lambda with batches of deduplicated posts, retrying only the failed ones
+        preprocessing_lambda.add_event_source(
+            LambdaEventSources.SqsEventSource(
+                self.deduplicated_posts_queue,
+                batch_size = 10,
+                max_batching_window = Duration.seconds(5),
+                report_batch_item_failures = True
+            )
+        )
 
 
         # Create lambda function to save messages from the SNS topic to s3 bucket
@@ -283,20 +360,66 @@ class CdkStack(Stack):
             code = LAMBDA.Code.from_asset(lambda_path),
             handler = "sns-to-s3.lambda_handler",
             dead_letter_queue = self.dead_letter_queue.queue,
+            timeout = Duration.seconds(60),
             function_name = "SavePreprocessedJobsToS3",
             environment = {
                 "SNS_TOPIC_ARN": self.sns_topic.topic_arn,
-                "S3_BUCKET_NAME": self.s3_bucket.bucket_name
+                "S3_BUCKET_NAME": self.s3_bucket.bucket_name,
+                "JOB_INDEX_TABLE_NAME": self.job_index_table.table_name
             }
         )
-        self.s3_bucket.grant_write(sns_to_s3)
-        
-        # Subscribe the lambda function to the sns topic
+        self.s3_bucket.grant_read_write(sns_to_s3)
+        self.job_index_table.grant_write_data(sns_to_s3)
+
+        # Subscribe the archive queue to the sns topic, and invoke the lambda function with batches
+        # of up to 100 messages, so each batch is saved as a single object
         self.sns_topic.add_subscription(
-            sns_subscriptions.LambdaSubscription(
-                sns_to_s3,
+            sns_subscriptions.SqsSubscription(
+                self.preprocessed_posts_archive_queue,
+                dead_letter_queue = self.dead_letter_queue.queue,
+                raw_message_delivery = True
             )
         )
+        sns_to_s3.add_event_source(
+            LambdaEventSources.SqsEventSource(
+                self.preprocessed_posts_archive_queue,
+                batch_size = 100,
+                max_batching_window = Duration.seconds(30),
+                report_batch_item_failures = True
+            )
+        )
+
+
+        # Create lambda function to compact the per-job objects of the bucket into daily JSONL shards
+        compact_s3 = LAMBDA.Function(
+            self,
+            "CompactS3Objects",
+            runtime = LAMBDA.Runtime.PYTHON_3_12,
+            code = LAMBDA.Code.from_asset(lambda_path),
+            handler = "compact-s3.lambda_handler",
+            dead_letter_queue = self.dead_letter_queue.queue,
+            function_name = "CompactS3Objects",
+            timeout = Duration.minutes(15),
+            memory_size = 1024,
+            environment = {
+                "S3_BUCKET_NAME": self.s3_bucket.bucket_name,
+                "COMPACTION_PREFIXES": "Preprocessed-posts/,Labeled-data/",
+                "COMPACTED_PREFIX": "Compacted/",
+                "SHARD_TARGET_BYTES": str(64 * 1024 * 1024),
+                "DELETE_COMPACTED_OBJECTS": "false",
+                "JOB_INDEX_TABLE_NAME": self.job_index_table.table_name
+            }
+        )
+        self.s3_bucket.grant_read_write(compact_s3)
+        self.job_index_table.grant_read_write_data(compact_s3)
+
+        # Run the compaction every night, when the previous day is complete
+        Events.Rule(
+            self,
+            "CompactS3ObjectsSchedule",
+            schedule = Events.Schedule.cron(minute="0", hour="3"),
+            targets = [EventsTargets.LambdaFunction(compact_s3)]
+        )
 
 
         # Create lambda function to bring preprocessed posts to the web page
@@ -307,13 +430,40 @@ class CdkStack(Stack):
             code = LAMBDA.Code.from_asset(lambda_path),
             handler = "fetch-from-queue.lambda_handler",
             dead_letter_queue = self.dead_letter_queue.queue,
+            timeout = Duration.seconds(15),
             function_name = "FetchJobsFromQueue",
             environment = {
                 "PREPROCESSED_JOBS_QUEUE_URL": self.preprocessed_job_posts_queue.queue_url,
                 "CORS_ORIGIN": self.website_bucket.bucket_website_url,
+                "S3_BUCKET_NAME": self.s3_bucket.bucket_name,
+                "FETCH_TIME_BUDGET_SECONDS": "5",
+                "JOB_LEASES_TABLE_NAME": self.job_leases_table.table_name,
+                "JOB_LEASE_SECONDS": "900"
             }
         )
         self.preprocessed_job_posts_queue.grant_consume_messages(fetch_posts)
+        self.s3_bucket.grant_read(fetch_posts)
+        self.job_leases_table.grant_read_write_data(fetch_posts)
+
+
+        # Create lambda function to renew and release the leases of the jobs open in the web page
+        job_leases = LAMBDA.Function(
+            self,
+            "JobLeases",
+            runtime = LAMBDA.Runtime.PYTHON_3_12,
+            code = LAMBDA.Code.from_asset(lambda_path),
+            handler = "job-lease.lambda_handler",
+            dead_letter_queue = self.dead_letter_queue.queue,
+            function_name = "JobLeases",
+            environment = {
+                "PREPROCESSED_JOBS_QUEUE_URL": self.preprocessed_job_posts_queue.queue_url,
+                "CORS_ORIGIN": self.website_bucket.bucket_website_url,
+                "JOB_LEASES_TABLE_NAME": self.job_leases_table.table_name,
+                "JOB_LEASE_SECONDS": "900"
+            }
+        )
+        self.preprocessed_job_posts_queue.grant_consume_messages(job_leases)
+        self.job_leases_table.grant_read_write_data(job_leases)
 
 
         # Create lambda function to save labeled posts to s3 bucket
@@ -324,14 +474,21 @@ class CdkStack(Stack):
             code = LAMBDA.Code.from_asset(lambda_path),
             handler = "save-to-s3.lambda_handler",
             dead_letter_queue = self.dead_letter_queue.queue,
+            timeout = Duration.seconds(25),
             function_name = "SaveJobsToS3",
             environment = {
                 "S3_BUCKET_NAME": self.s3_bucket.bucket_name,
                 "CORS_ORIGIN": self.website_bucket.bucket_website_url,
-                "LABELED_POSTS_PREFIX" : "labeled_posts/"
+                "LABELED_POSTS_PREFIX" : "labeled_posts/",
+                "PREPROCESSED_JOBS_QUEUE_URL": self.preprocessed_job_posts_queue.queue_url,
+                "JOB_LEASES_TABLE_NAME": self.job_leases_table.table_name,
+                "JOB_INDEX_TABLE_NAME": self.job_index_table.table_name
             }
         )
         self.s3_bucket.grant_write(save_labeled_posts)
+        self.job_index_table.grant_write_data(save_labeled_posts)
+        self.preprocessed_job_posts_queue.grant_consume_messages(save_labeled_posts)
+        self.job_leases_table.grant_read_write_data(save_labeled_posts)
 
 
 
@@ -344,6 +501,8 @@ class CdkStack(Stack):
             rest_api_name = "Label-app-API",
             description = "API for the Label App",
             deploy = True,
+            # Responses larger than 1 KB are gzip compressed for clients sending Accept-Encoding
+            min_compression_size = Size.kibibytes(1),
             deploy_options = APIGateway.StageOptions(
                 stage_name = "prod"
             )
@@ -362,4 +521,19 @@ class CdkStack(Stack):
         jobs_resource.add_method(
             "POST",
             APIGateway.LambdaIntegration(save_labeled_posts),
+        )
+
+        leases_resource = jobs_resource.add_resource("Leases")
+        leases_resource.add_cors_preflight(
+            allow_origins = [self.website_bucket.bucket_website_url],
+            allow_methods = ["PUT", "DELETE", "OPTIONS"],
+            allow_headers = ["Content-Type", "X-Amz-Date", "Authorization", "X-Api-Key", "X-Amz-Security-Token"]
+        )
+        leases_resource.add_method(
+            "PUT",
+            APIGateway.LambdaIntegration(job_leases),
+        )
+        leases_resource.add_method(
+            "DELETE",
+            APIGateway.LambdaIntegration(job_leases),
         )
\ No newline at end of file
@@ -0,0 +1,241 @@
+import os
+import io
+import json
+import gzip
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import preprocessing.awsutils as aws_ut
+
+
+# Prefixes of the per-job objects to compact, each one compacted into its own dataset
+COMPACTION_PREFIXES = [prefix for prefix in os.getenv("COMPACTION_PREFIXES", "Preprocessed-posts/,Labeled-data/").split(",") if prefix]
+
+# Prefix of the compacted datasets: <prefix><dataset>/dt=YYYY-MM-DD/part-NNNNN.jsonl.gz and manifest.json
+COMPACTED_PREFIX = os.getenv("COMPACTED_PREFIX", "Compacted/")
+
+# Compressed size at which a shard is closed and a new one started
+SHARD_TARGET_BYTES = int(os.getenv("SHARD_TARGET_BYTES", str(64 * 1024 * 1024)))
+
+# The per-job objects are kept after compaction, unless this is "true"
+DELETE_COMPACTED_OBJECTS = os.getenv("DELETE_COMPACTED_OBJECTS", "false").lower() == "true"
+
+# Objects downloaded at the same time, and objects read before their records are written
+MAX_PARALLEL_READS = int(os.getenv("MAX_PARALLEL_READS", "32"))
+READ_CHUNK_SIZE = 1000
+
+# Kind of the job index entries pointing to the objects of each prefix
+INDEX_KINDS = {"Preprocessed-posts/": "Preprocessed", "Labeled-data/": "Labeled"}
+
+# A partition is started only if the lambda has at least this time left. Nothing bounds how long a partition takes:
+# when less than STOP_REMAINING_SECONDS are left, its compaction is abandoned before the manifest is written,
+# and the partition is compacted again from the start by the next run
+MIN_REMAINING_SECONDS = 180
+STOP_REMAINING_SECONDS = 60
+
+# Partitions whose per-job objects still have to be deleted, with the new location of their jobs:
+# <prefix><dataset>/dt=YYYY-MM-DD.json, written before the manifest and removed once the objects are deleted
+CLEANUP_PREFIX = f"{COMPACTED_PREFIX}_cleanup/"
+
+
+# Compacted partition of the objects of a day
+def _partitionPrefix(prefix: str, day: str):
+    return f"{COMPACTED_PREFIX}{prefix.strip('/')}/dt={day}/"
+
+
+# Cleanup file of the partition of a day
+def _cleanupKey(prefix: str, day: str):
+    return f"{CLEANUP_PREFIX}{prefix.strip('/')}/dt={day}.json"
+
+
+# Check if the lambda has at least the given seconds left (always true without a context)
+def _hasTimeLeft(context, seconds: int):
+    return context is None or context.get_remaining_time_in_millis() >= seconds * 1000
+
+
+# Find the past days with objects under the prefix, the current one is still being written.
+# Objects are saved under a dt=YYYY-MM-DD/ partition of their day, found without listing its objects;
+# objects saved at the top of the prefix, before keys were partitioned, are grouped by the day they were written.
+# Returns, for each day, the keys of its objects at the top of the prefix
+def _findDays(bucket_name: str, prefix: str):
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    days = {}
+    for day_prefix in aws_ut._listPrefixesInS3Bucket(bucket_name, prefix):
+        partition = day_prefix[len(prefix):].rstrip('/')
+        if partition.startswith('dt=') and partition[3:] < today:
+            days.setdefault(partition[3:], [])
+
+    for s3_object in aws_ut._listObjectsInS3Bucket(bucket_name, prefix, delimiter='/'):
+        day = s3_object['LastModified'].astimezone(timezone.utc).strftime('%Y-%m-%d')
+        if day < today:
+            days.setdefault(day, []).append(s3_object['Key'])
+
+    return dict(sorted(days.items()))
+
+
+# Parse the records of an object: a single JSON document, or one JSON document per line
+def _parseRecords(body: str):
+    try:
+        return [json.loads(body)]
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+# Write the objects of a partition into gzipped JSONL shards of about SHARD_TARGET_BYTES, then its manifest.
+# The manifest is written last: a partition without manifest is compacted again from the start.
+# If the objects are to be deleted, the cleanup file is written just before the manifest.
+# Raises TimeoutError, after removing the shards already written, if the lambda is running out of time.
+# Returns the manifest and the keys of the objects compacted
+def _compactPartition(bucket_name: str, prefix: str, day: str, keys: list, context=None):
+    partition_prefix = _partitionPrefix(prefix, day)
+    shards, compacted_keys, locations = [], [], []
+    records, skipped = 0, 0
+
+    buffer = io.BytesIO()
+    shard = gzip.GzipFile(fileobj=buffer, mode="wb")
+    shard_records = 0
+
+    def shardKey(number: int):
+        return f"{partition_prefix}part-{number:05d}.jsonl.gz"
+
+    def flushShard():
+        shard.close()
+        key = shardKey(len(shards))
+        if not aws_ut._saveJobToS3Bucket(bucket_name, buffer.getvalue(), key, content_type="application/gzip"):
+            raise RuntimeError(f"Failed to save shard {key}")
+        shards.append({"Key": key, "Records": shard_records, "Bytes": buffer.tell()})
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_READS) as executor:
+        for i in range(0, len(keys), READ_CHUNK_SIZE):
+            if not _hasTimeLeft(context, STOP_REMAINING_SECONDS):
+                aws_ut._deleteObjectsFromS3Bucket(bucket_name, [shard_info["Key"] for shard_info in shards])
+                raise TimeoutError(f"Out of time compacting {partition_prefix} after {i} of {len(keys)} objects")
+
+            chunk = keys[i:i + READ_CHUNK_SIZE]
+            bodies = executor.map(lambda key: aws_ut._readObjectFromS3Bucket(bucket_name, key), chunk)
+
+            for key, body in zip(chunk, bodies):
+                try:
+                    object_records = _parseRecords(body)
+                except (TypeError, json.JSONDecodeError) as e:
+                    print(f"Skipping {key}: {e}")
+                    skipped += 1
+                    continue
+
+                for line, record in enumerate(object_records, start=shard_records):
+                    job_id = (record.get('Job_ID') or record.get('jobId')) if isinstance(record, dict) else None
+                    if job_id:
+                        locations.append({'Job_ID': job_id, 'Old_key': key, 'Key': shardKey(len(shards)), 'Line': line})
+                    shard.write((json.dumps(record, separators=(',', ':'), ensure_ascii=False) + "\n").encode("utf-8"))
+                shard_records += len(object_records)
+                records += len(object_records)
+                compacted_keys.append(key)
+
+                if buffer.tell() >= SHARD_TARGET_BYTES:
+                    flushShard()
+                    buffer = io.BytesIO()
+                    shard = gzip.GzipFile(fileobj=buffer, mode="wb")
+                    shard_records = 0
+
+    if shard_records:
+        flushShard()
+
+    manifest = {
+        "Dataset": prefix.strip('/'),
+        "Partition": f"dt={day}",
+        "Source_prefix": prefix,
+        "Source_objects": len(compacted_keys),
+        "Skipped_objects": skipped,
+        "Records": records,
+        "Shards": shards,
+        "Created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+    if DELETE_COMPACTED_OBJECTS:
+        cleanup = {"Partition": partition_prefix, "Kind": INDEX_KINDS.get(prefix), "Keys": compacted_keys, "Locations": locations}
+        if not aws_ut._saveJobToS3Bucket(bucket_name, json.dumps(cleanup, separators=(',', ':')), _cleanupKey(prefix, day)):
+            raise RuntimeError(f"Failed to save cleanup file of {partition_prefix}")
+
+    if not aws_ut._saveJobToS3Bucket(bucket_name, json.dumps(manifest, indent=2), f"{partition_prefix}manifest.json"):
+        raise RuntimeError(f"Failed to save manifest of {partition_prefix}")
+
+    return manifest, compacted_keys
+
+
+# Delete the per-job objects of the compacted partitions with a cleanup file, READ_CHUNK_SIZE objects at a time.
+# The job index must point to the shards before the objects it points to are deleted: objects whose entries
+# could not be updated are kept. Both steps can be repeated, so a cleanup cut by the timeout is started again
+# by the next run, until its file is removed. Returns False if it stopped because time was running out
+def _cleanUpPartitions(bucket_name: str, job_index_table_name: str, context=None):
+    for cleanup_object in list(aws_ut._listObjectsInS3Bucket(bucket_name, CLEANUP_PREFIX)):
+        body = aws_ut._readObjectFromS3Bucket(bucket_name, cleanup_object['Key'])
+        if body is None:
+            continue
+        cleanup = json.loads(body)
+
+        # Without manifest the partition is compacted again, and its cleanup file rewritten
+        if not aws_ut._checkIfObjectExistsInS3Bucket(bucket_name, f"{cleanup['Partition']}manifest.json"):
+            continue
+
+        locations = {}
+        for location in cleanup['Locations']:
+            locations.setdefault(location['Old_key'], []).append(dict(location, Kind=cleanup['Kind']))
+
+        kept = 0
+        keys = cleanup['Keys']
+        for i in range(0, len(keys), READ_CHUNK_SIZE):
+            if not _hasTimeLeft(context, STOP_REMAINING_SECONDS):
+                print(f"Not enough time left, the cleanup of {cleanup['Partition']} is resumed by the next run")
+                return False
+
+            chunk = keys[i:i + READ_CHUNK_SIZE]
+            failed_keys = set()
+            if job_index_table_name and cleanup['Kind']:
+                failed_keys = aws_ut._repointJobIndex(job_index_table_name, [location for key in chunk for location in locations.get(key, [])])
+            kept += len(failed_keys)
+            aws_ut._deleteObjectsFromS3Bucket(bucket_name, [key for key in chunk if key not in failed_keys])
+
+        print(f"Deleted the compacted objects of {cleanup['Partition']}, {kept} kept")
+        aws_ut._deleteObjectsFromS3Bucket(bucket_name, [cleanup_object['Key']])
+
+    return True
+
+
+# Compact the per-job objects of each past day into a partition of shards, skipping the partitions
+# already compacted, then delete the compacted objects if required.
+# Scheduled once a day; partitions and cleanups left over when time runs out are done by the next run
+def lambda_handler(event, context):
+    s3_bucket_name = os.getenv('S3_BUCKET_NAME')
+    job_index_table_name = os.getenv('JOB_INDEX_TABLE_NAME')
+
+    if not s3_bucket_name:
+        print("Bucket name not defined")
+        return
+
+    compacted = []
+    for prefix in COMPACTION_PREFIXES:
+        for day, keys in _findDays(s3_bucket_name, prefix).items():
+            partition_prefix = _partitionPrefix(prefix, day)
+            if aws_ut._checkIfObjectExistsInS3Bucket(s3_bucket_name, f"{partition_prefix}manifest.json"):
+                continue
+
+            if not _hasTimeLeft(context, MIN_REMAINING_SECONDS):
+                print("Not enough time left, the remaining partitions are compacted by the next run")
+                return {"compacted": compacted, "complete": False}
+
+            try:
+                keys = sorted(keys + [s3_object['Key'] for s3_object in aws_ut._listObjectsInS3Bucket(s3_bucket_name, f"{prefix}dt={day}/")])
+                manifest, compacted_keys = _compactPartition(s3_bucket_name, prefix, day, keys, context)
+            except TimeoutError as e:
+                print(f"{e}, the partition is compacted again by the next run")
+                return {"compacted": compacted, "complete": False}
+            except Exception as e:
+                print(f"Error compacting {partition_prefix}: {e}")
+                continue
+
+            print(f"Compacted {len(compacted_keys)} objects into {len(manifest['Shards'])} shards under {partition_prefix}")
+            compacted.append(partition_prefix)
+
+    if DELETE_COMPACTED_OBJECTS and not _cleanUpPartitions(s3_bucket_name, job_index_table_name, context):
+        return {"compacted": compacted, "complete": False}
+
+    return {"compacted": compacted, "complete": True}
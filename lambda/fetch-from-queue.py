@@ -1,10 +1,88 @@
 import os
 import json
+import time
 import preprocessing.awsutils as aws_ut
+import preprocessing.payload as payload_ut
+
+
+# Jobs returned when the request has no count parameter, and the most a request can ask for
+DEFAULT_JOBS_PER_REQUEST = 10
+MAX_JOBS_PER_REQUEST = 50
+
+# Seconds spent at most waiting for messages in a single request
+FETCH_TIME_BUDGET_SECONDS = float(os.getenv("FETCH_TIME_BUDGET_SECONDS", "5"))
+
+# Seconds an annotator holds a job before it goes back to the queue, unless the lease is renewed
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))
+
+# Vocabularies already downloaded by this container, by tokenizer tag
+vocabularies = {}
+
+
+# Load the vocabulary of the tokenizer that produced a payload, saved in S3 by the preprocessing lambda
+def _loadVocabulary(bucket_name: str, tokenizer_tag: str):
+    if tokenizer_tag not in vocabularies:
+        vocabulary = aws_ut._readObjectFromS3Bucket(bucket_name, payload_ut._vocabularyKey(tokenizer_tag))
+        if vocabulary is None:
+            raise ValueError(f"Vocabulary of {tokenizer_tag} not found")
+        vocabularies[tokenizer_tag] = json.loads(vocabulary)
+    return vocabularies[tokenizer_tag]
+
+
+# Get the token strings of a job. Jobs preprocessed before the compact payload carry a list of tokens
+def _decodeJobTokens(job_data: dict, bucket_name: str):
+    payload = job_data.get('Tokens')
+    if not isinstance(payload, dict):
+        return job_data.get('Description', [])
+
+    vocabulary = _loadVocabulary(bucket_name, payload['Tokenizer'])
+    ids, _, _ = payload_ut._decodeTokenPayload(payload)
+    return [vocabulary[token_id] for token_id in ids]
+
+
+# Read the number of jobs requested from the count query parameter, between 1 and MAX_JOBS_PER_REQUEST
+def _readRequestedCount(event: dict):
+    query_parameters = (event or {}).get('queryStringParameters') or {}
+    try:
+        count = int(query_parameters.get('count', DEFAULT_JOBS_PER_REQUEST))
+    except ValueError:
+        count = DEFAULT_JOBS_PER_REQUEST
+    return max(1, min(count, MAX_JOBS_PER_REQUEST))
+
+
+# Receive messages with batched long polls until count messages are collected or the time budget runs out.
+# An empty long poll means the queue has nothing left to give
+# Messages are received with the visibility timeout of a job lease, and carry in Received_at the time
+# taken before their receive call, from which their lease expires
+def _receiveJobs(queue_url: str, count: int, time_budget: float):
+    deadline = time.monotonic() + time_budget
+    messages = []
+
+    while len(messages) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        received_at = time.time()
+        batch = aws_ut._readJobFromSQSQueue(
+            queue_url,
+            max_messages = min(10, count - len(messages)),
+            wait_seconds = min(20, int(remaining)),
+            visibility_timeout = JOB_LEASE_SECONDS
+        )
+        if not batch:
+            break
+        for message in batch:
+            message['Received_at'] = received_at
+        messages.extend(batch)
+
+    return messages
 
 
 def lambda_handler(event, context):
     sqs_queue_url = os.getenv("PREPROCESSED_JOBS_QUEUE_URL")
+    s3_bucket_name = os.getenv("S3_BUCKET_NAME")
+    job_leases_table_name = os.getenv("JOB_LEASES_TABLE_NAME")
     processed_jobs = []
     cors_headers = {
         'Access-Control-Allow-Origin': os.getenv('CORS_ORIGIN'),
@@ -23,9 +101,25 @@ def lambda_handler(event, context):
                     'jobs': []
                 })
         }
+
+    if not job_leases_table_name:
+        print("Job leases table name not found")
+        return {
+                'statusCode': 500,
+                'headers': cors_headers,
+                'body': json.dumps({
+                    'error': 'Job leases table not configured',
+                    'jobs': []
+                })
+        }
     
     try:
-        messages = aws_ut._readJobFromSQSQueue(sqs_queue_url)
+        # Leave a margin to build the response before the lambda times out
+        time_budget = FETCH_TIME_BUDGET_SECONDS
+        if context is not None:
+            time_budget = min(time_budget, context.get_remaining_time_in_millis() / 1000 - 3)
+
+        messages = _receiveJobs(sqs_queue_url, _readRequestedCount(event), time_budget)
         if not messages:
             print("No messages in the queue")
             return {
@@ -44,37 +138,48 @@ def lambda_handler(event, context):
                 print("Message body or receipt handle is empty")
                 continue
 
+            # Large jobs arrive as a claim-check pointer to the job saved in S3
+            job = aws_ut._resolveClaimCheck(job)
+            if job is None:
+                continue
+
             try:
                 job_data = json.loads(job)
-                bert_tokens = job_data.get('Description', [])
-                token_objects = []
-                if isinstance(bert_tokens, list):
-                    for i, token in enumerate(bert_tokens):
-                        token_objects.append({
-                            'id': i,
-                            'text': token,
-                            'label': '',
-                            'position': i
-                        })
-
-                formatted_job = {
-                    'Job_ID': job_data.get('Job_ID'),
-                    'Title': job_data.get('Title', 'No title'),
-                    'Company': job_data.get('Company', 'No company'),
-                    'Tokens': token_objects,
-                    'Total_tokens': len(token_objects)
-                }
-                
-                processed_jobs.append(formatted_job)
+                bert_tokens = _decodeJobTokens(job_data, s3_bucket_name)
+                if not isinstance(bert_tokens, list):
+                    bert_tokens = []
 
             except Exception as e:
+                # Leave the message in the queue: after too many receives it goes to the dead letter queue
                 print(f"Error parsing job body: {e}")
+                continue
+
+            # The message stays in the queue, hidden while the lease lasts, until the labels are saved.
+            # A leased message received again is hidden until its lease expires, never deleted
+            lease_id, duplicate = aws_ut._createJobLease(
+                job_leases_table_name, sqs_queue_url, job_data.get('Job_ID'), message.get('MessageId'),
+                receipt_handle, JOB_LEASE_SECONDS, message['Received_at']
+            )
+            if duplicate:
+                # Another message of a job checked out by another annotator: the leased message stays in the queue
+                print(f"Job {job_data.get('Job_ID')} is already leased with another message, duplicate message deleted")
+                aws_ut._deleteJobFromSQSQueue(sqs_queue_url, receipt_handle)
+                continue
+            if lease_id is None:
+                print(f"Job {job_data.get('Job_ID')} not checked out")
+                continue
 
-            print(f"Processing message: {job}")
+            # Tokens are sent as a plain array of strings: the web page builds the token objects it labels
+            formatted_job = {
+                'Job_ID': job_data.get('Job_ID'),
+                'Title': job_data.get('Title', 'No title'),
+                'Company': job_data.get('Company', 'No company'),
+                'Tokens': bert_tokens,
+                'Lease_ID': lease_id,
+                'Lease_seconds': JOB_LEASE_SECONDS
+            }
 
-            aws_ut._deleteJobFromSQSQueue(sqs_queue_url, receipt_handle)
-            
-            print("Message processed and deleted from the queue")
+            processed_jobs.append(formatted_job)
         
         return {
                 'statusCode': 200,
@@ -82,7 +187,7 @@ def lambda_handler(event, context):
                 'body': json.dumps({
                     'message': f'Successfully processed {len(processed_jobs)} jobs',
                     'jobs': processed_jobs
-                })
+                }, separators=(',', ':'))
         }
 
     except Exception as e:
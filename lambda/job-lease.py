@@ -0,0 +1,63 @@
+import os
+import json
+import preprocessing.awsutils as aws_ut
+
+
+# Seconds added to the lease of a job by each renewal
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))
+
+
+# Renew (PUT) or release (DELETE) the leases of the jobs open in the web page.
+# The body is {"leases": [{"jobId": ..., "leaseId": ...}, ...]}, the response lists the leases
+# renewed or released and the ones lost, whose jobs went back to the queue
+def lambda_handler(event, context):
+    sqs_queue_url = os.getenv("PREPROCESSED_JOBS_QUEUE_URL")
+    job_leases_table_name = os.getenv("JOB_LEASES_TABLE_NAME")
+    cors_headers = {
+        'Access-Control-Allow-Origin': os.getenv('CORS_ORIGIN'),
+        'Access-Control-Allow-Methods': 'PUT, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Amz-Date, Authorization, X-Api-Key, X-Amz-Security-Token',
+        'Content-Type': 'application/json'
+    }
+
+    if not sqs_queue_url or not job_leases_table_name:
+        print("Queue URL or job leases table name not defined")
+        return {
+            'statusCode': 500,
+            'headers': cors_headers,
+            'body': json.dumps({'error': 'Job leases not configured.'})
+        }
+
+    try:
+        leases = json.loads(event.get("body") or "{}").get("leases", [])
+        release = event.get("httpMethod") == "DELETE"
+
+        held, lost = [], []
+        for lease in leases:
+            job_id = lease.get("jobId")
+            lease_id = lease.get("leaseId")
+
+            if release:
+                ok = aws_ut._releaseJobLease(job_leases_table_name, sqs_queue_url, job_id, lease_id, done=False)
+            else:
+                ok = aws_ut._renewJobLease(job_leases_table_name, sqs_queue_url, job_id, lease_id, JOB_LEASE_SECONDS)
+
+            (held if ok else lost).append(job_id)
+
+        return {
+            'statusCode': 200,
+            'headers': cors_headers,
+            'body': json.dumps({
+                'released' if release else 'renewed': held,
+                'lost': lost,
+                'leaseSeconds': JOB_LEASE_SECONDS
+            })
+        }
+
+    except Exception as e:
+        print(f"Error updating job leases: {e}")
+        return {
+            'statusCode': 500,
+            'headers': cors_headers,
+            'body': json.dumps({'error': f'Failed to update job leases: {str(e)}'})
+        }
@@ -1,27 +1,51 @@
 import os
+import time
+import uuid
+import threading
 import boto3
+from botocore.config import Config
 import hashlib
 import json
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 
-try:
-    print("Initializing AWS services...")
-    dynamodb = boto3.resource('dynamodb')
-    sqs_client = boto3.client('sqs')
-    sns_client = boto3.client('sns')
-    s3_client = boto3.client('s3')
-    
-    session = boto3.Session()
-    print(f"AWS session region: {session.region_name}")
-    print("AWS services initialized successfully")
-    
-except Exception as e:
-    print(f"ERROR: Failed to initialize AWS services: {e}")
-    raise
+# Connections kept open to each AWS service, enough for the threads calling it at the same time
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "32"))
+
+# Configuration shared by all the clients: standard retry mode, with exponential backoff of throttled
+# and failed calls, and TCP keep-alive on the pooled connections, so they are reused between calls
+_aws_config = Config(
+    max_pool_connections = AWS_MAX_POOL_CONNECTIONS,
+    retries = {'mode': 'standard', 'max_attempts': 5},
+    tcp_keepalive = True
+)
+
+# Clients and resources created so far, by service
+_aws_clients = {}
+_aws_clients_lock = threading.Lock()
+
+
+# Return the client (or the resource) of an AWS service, created the first time it is needed and then reused.
+# Only the services actually called are initialized
+def _getAWSClient(service_name: str, resource: bool = False):
+    name = f"{service_name}-resource" if resource else service_name
+    if name in _aws_clients:
+        return _aws_clients[name]
+
+    with _aws_clients_lock:
+        if name not in _aws_clients:
+            # DYNAMODB_ENDPOINT_URL points the lambdas to DynamoDB Local when they run outside AWS
+            options = {'endpoint_url': os.getenv("DYNAMODB_ENDPOINT_URL")} if service_name == 'dynamodb' else {}
+            factory = boto3.resource if resource else boto3.client
+            _aws_clients[name] = factory(service_name, config=_aws_config, **options)
+
+    return _aws_clients[name]
 
 
 # Retrieve the SQS queue by queue name
-def _retrieveSQSQueueUrl(queue_name: str, sqs_client=sqs_client):
+def _retrieveSQSQueueUrl(queue_name: str, sqs_client=None):
+    sqs_client = sqs_client or _getAWSClient('sqs')
     try:
         queue = sqs_client.get_queue_url(QueueName=queue_name)
         return queue.get('QueueUrl')
@@ -31,12 +55,21 @@ def _retrieveSQSQueueUrl(queue_name: str, sqs_client=sqs_client):
         return None
 
 
-# Receive 5 messages from the specified queue
-def _readJobFromSQSQueue(queue_url: str, sqs_client=sqs_client):
+# Receive up to max_messages messages (at most 10) from the specified queue.
+# With wait_seconds > 0 (at most 20) the call long polls, waiting for messages to arrive.
+# visibility_timeout overrides the visibility timeout of the queue for the messages received
+def _readJobFromSQSQueue(queue_url: str, sqs_client=None, max_messages: int = 5, wait_seconds: int = 0, visibility_timeout: int = None):
+    sqs_client = sqs_client or _getAWSClient('sqs')
     try:
+        options = {}
+        if visibility_timeout is not None:
+            options['VisibilityTimeout'] = visibility_timeout
+
         response = sqs_client.receive_message(
             QueueUrl = queue_url,
-            MaxNumberOfMessages = 5,
+            MaxNumberOfMessages = max_messages,
+            WaitTimeSeconds = wait_seconds,
+            **options
         )
         return response.get('Messages', [])
     
@@ -46,7 +79,8 @@ def _readJobFromSQSQueue(queue_url: str, sqs_client=sqs_client):
 
 
 # Delete a message from the specified queue
-def _deleteJobFromSQSQueue(queue_url: str, receipt_handle: str, sqs_client=sqs_client):
+def _deleteJobFromSQSQueue(queue_url: str, receipt_handle: str, sqs_client=None):
+    sqs_client = sqs_client or _getAWSClient('sqs')
     try:
         sqs_client.delete_message(
             QueueUrl = queue_url,
@@ -59,31 +93,408 @@ def _deleteJobFromSQSQueue(queue_url: str, receipt_handle: str, sqs_client=sqs_c
         return None
 
 
-# Publish a job post to the specified sns topic
-def _writeJobToSNSTopic(sns_topic_arn: str, job: str, sns_client=sns_client):
+# Split the entries into batches of at most 10 entries and max_batch_bytes total size
+def _splitIntoBatches(entries: list, max_batch_bytes: int = 256 * 1024):
+    batches = []
+    batch, batch_bytes = [], 0
+
+    for entry in entries:
+        entry_bytes = len(entry[1].encode('utf-8'))
+        if batch and (len(batch) == 10 or batch_bytes + entry_bytes > max_batch_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+# Publish the job posts to the specified sns topic with PublishBatch, up to 10 per call.
+# Jobs is a list of (job_id, message) pairs. Returns the set of the ids of the jobs published
+def _writeJobsToSNSTopic(sns_topic_arn: str, jobs: list, sns_client=None):
+    sns_client = sns_client or _getAWSClient('sns')
+    published_ids = set()
+
+    for batch in _splitIntoBatches(jobs):
+        # Batch entry ids allow only a few characters, so the position in the batch is used
+        try:
+            response = sns_client.publish_batch(
+                TopicArn = sns_topic_arn,
+                PublishBatchRequestEntries = [{'Id': str(i), 'Message': message} for i, (_, message) in enumerate(batch)]
+            )
+        except Exception as e:
+            print(f"Error publishing message batch to SNS: {e}")
+            continue
+
+        for entry in response.get('Successful', []):
+            published_ids.add(batch[int(entry['Id'])][0])
+
+        for entry in response.get('Failed', []):
+            print(f"Error publishing job {batch[int(entry['Id'])][0]} to SNS: {entry.get('Message')}")
+
+    return published_ids
+
+
+# Delete the messages with the receipt handles received from the specified queue with DeleteMessageBatch,
+# up to 10 per call. Returns the list of the receipt handles not deleted
+def _deleteJobsFromSQSQueue(queue_url: str, receipt_handles: list, sqs_client=None):
+    sqs_client = sqs_client or _getAWSClient('sqs')
+    failed_handles = []
+
+    for i in range(0, len(receipt_handles), 10):
+        batch = receipt_handles[i:i + 10]
+        try:
+            response = sqs_client.delete_message_batch(
+                QueueUrl = queue_url,
+                Entries = [{'Id': str(j), 'ReceiptHandle': handle} for j, handle in enumerate(batch)]
+            )
+        except Exception as e:
+            print(f"Error deleting message batch from SQS: {e}")
+            failed_handles.extend(batch)
+            continue
+
+        for entry in response.get('Failed', []):
+            print(f"Error deleting message from SQS: {entry.get('Message')}")
+            failed_handles.append(batch[int(entry['Id'])])
+
+    return failed_handles
+
+
+
+# Check out a job received from the queue: its message id and receipt handle are saved in the job leases table
+# under a new lease id, which is the only thing the annotator gets. A job received again replaces its lease only if it expired.
+# The lease expires lease_seconds after received_at, taken before the message was received with a visibility timeout
+# of lease_seconds, so the message never becomes visible while the lease is still valid.
+# Returns the lease id and whether the message is a duplicate of a job leased with another message,
+# which can be deleted; the lease id is None if not created
+def _createJobLease(table_name: str, queue_url: str, job_id: str, message_id: str, receipt_handle: str, lease_seconds: int, received_at: float, dynamodb=None, sqs_client=None):
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
+    lease_id = uuid.uuid4().hex
+    now = int(time.time())
+    expires = int(received_at) + lease_seconds
+    table = dynamodb.Table(table_name)
     try:
-        response = sns_client.publish(
-            TopicArn = sns_topic_arn,
-            Message = job
+        table.put_item(
+            Item = {
+                'Job_ID': job_id,
+                'Lease_ID': lease_id,
+                'Message_ID': message_id,
+                'Receipt_handle': receipt_handle,
+                'Lease_expires': expires,
+                'ttl': expires + 24 * 3600
+            },
+            ConditionExpression = "attribute_not_exists(Job_ID) OR Lease_expires < :now",
+            ExpressionAttributeValues = {':now': now}
         )
-        return
-    
+        return lease_id, False
+
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+    except Exception as e:
+        print(f"Error saving job lease: {e}")
+        return None, False
+
+    try:
+        lease = table.get_item(Key={'Job_ID': job_id}, ConsistentRead=True).get('Item')
+        if not lease:
+            return None, False
+
+        # Leases saved before the message id was stored are never taken for duplicates
+        if lease.get('Message_ID') not in (None, message_id):
+            return None, True
+
+        # The leased message itself came back: only its latest receipt handle can delete it,
+        # so the lease takes the new one and the message is hidden again until the lease expires
+        table.update_item(
+            Key = {'Job_ID': job_id},
+            UpdateExpression = "SET Receipt_handle = :handle",
+            ConditionExpression = "Lease_ID = :lease AND Lease_expires >= :now",
+            ExpressionAttributeValues = {':handle': receipt_handle, ':lease': lease['Lease_ID'], ':now': now}
+        )
+        sqs_client = sqs_client or _getAWSClient('sqs')
+        sqs_client.change_message_visibility(
+            QueueUrl = queue_url,
+            ReceiptHandle = receipt_handle,
+            VisibilityTimeout = int(lease['Lease_expires']) - now
+        )
+        return None, False
+
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None, False
+
+    except Exception as e:
+        print(f"Error updating job lease: {e}")
+        return None, False
+
+
+# Read the lease of a job. Returns None if the job has no lease or the lease belongs to another annotator
+def _readJobLease(table_name: str, job_id: str, lease_id: str, dynamodb=None):
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
+    try:
+        lease = dynamodb.Table(table_name).get_item(Key={'Job_ID': job_id}, ConsistentRead=True).get('Item')
+
     except Exception as e:
-        print(f"Error publishing message to SNS: {e}")
+        print(f"Error reading job lease: {e}")
         return None
-    
 
-# Save a job post to the specified S3 bucket
-def _saveJobToS3Bucket(bucket_name: str, job: str, key: str, s3_client=s3_client):
+    if not lease or lease.get('Lease_ID') != lease_id:
+        return None
+    return lease
+
+
+# Extend a lease that has not expired, and the visibility timeout of its message with it.
+# The message is hidden for longer first, then the lease is extended from a time taken before, so the message
+# never becomes visible while the lease is valid. The lease is extended only if its receipt handle did not change
+# in the meantime, otherwise it is read again. Returns False if the lease expired or belongs to another annotator
+def _renewJobLease(table_name: str, queue_url: str, job_id: str, lease_id: str, lease_seconds: int, dynamodb=None, sqs_client=None, max_attempts: int = 3):
+    sqs_client = sqs_client or _getAWSClient('sqs')
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
+    table = dynamodb.Table(table_name)
+    try:
+        for attempt in range(max_attempts):
+            now = int(time.time())
+            lease = table.get_item(Key={'Job_ID': job_id}, ConsistentRead=True).get('Item')
+            if not lease or lease.get('Lease_ID') != lease_id or int(lease['Lease_expires']) <= now:
+                return False
+
+            sqs_client.change_message_visibility(
+                QueueUrl = queue_url,
+                ReceiptHandle = lease['Receipt_handle'],
+                VisibilityTimeout = lease_seconds
+            )
+
+            try:
+                table.update_item(
+                    Key = {'Job_ID': job_id},
+                    UpdateExpression = "SET Lease_expires = :expires, #ttl = :ttl",
+                    ConditionExpression = "Lease_ID = :lease AND Receipt_handle = :handle AND Lease_expires > :now",
+                    ExpressionAttributeNames = {'#ttl': 'ttl'},
+                    ExpressionAttributeValues = {
+                        ':lease': lease_id,
+                        ':handle': lease['Receipt_handle'],
+                        ':expires': now + lease_seconds,
+                        ':ttl': now + lease_seconds + 24 * 3600,
+                        ':now': now
+                    }
+                )
+                return True
+
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+
+        return False
+
+    except Exception as e:
+        print(f"Error renewing job lease: {e}")
+        return False
+
+
+# Give back a job: the lease is deleted and the message is deleted from the queue if the job is done,
+# or made visible again for the other annotators if it is not. Returns False if the lease is not held
+def _releaseJobLease(table_name: str, queue_url: str, job_id: str, lease_id: str, done: bool, dynamodb=None, sqs_client=None):
+    sqs_client = sqs_client or _getAWSClient('sqs')
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
+    table = dynamodb.Table(table_name)
+    try:
+        response = table.delete_item(
+            Key = {'Job_ID': job_id},
+            ConditionExpression = "Lease_ID = :lease",
+            ExpressionAttributeValues = {':lease': lease_id},
+            ReturnValues = "ALL_OLD"
+        )
+        receipt_handle = response['Attributes']['Receipt_handle']
+
+        if done:
+            sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
+        else:
+            sqs_client.change_message_visibility(QueueUrl=queue_url, ReceiptHandle=receipt_handle, VisibilityTimeout=0)
+        return True
+
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+    except Exception as e:
+        print(f"Error releasing job lease: {e}")
+        return False
+
+
+# Save a job post to the specified S3 bucket. Returns True if the job was saved
+def _saveJobToS3Bucket(bucket_name: str, job: str, key: str, s3_client=None, content_type: str = "application/json"):
+    s3_client = s3_client or _getAWSClient('s3')
     try:
         s3_client.put_object(
             Bucket = bucket_name,
             Key = key,
             Body = job,
-            ContentType = "application/json"
+            ContentType = content_type
         )
-        return
+        return True
     
     except Exception as e:
         print(f"Error saving job to S3: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+# Save several objects to the specified S3 bucket with parallel put requests.
+# objects is a list of (key, body) pairs. Returns the set of the keys saved
+def _saveJobsToS3Bucket(bucket_name: str, objects: list, max_workers: int = 8, s3_client=None):
+    s3_client = s3_client or _getAWSClient('s3')
+    if not objects:
+        return set()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(objects))) as executor:
+        saved = executor.map(lambda item: _saveJobToS3Bucket(bucket_name, item[1], item[0], s3_client), objects)
+        return {key for (key, _), ok in zip(objects, saved) if ok}
+
+
+# Key of an object of a dataset in the bucket, partitioned by UTC day and then by a hash prefix of its name,
+# so writes spread over 256 prefixes per day: <prefix>dt=YYYY-MM-DD/<2 hex digits>/<name>
+def _partitionedObjectKey(prefix: str, name: str):
+    day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    hash_prefix = hashlib.sha256(name.encode('utf-8')).hexdigest()[:2]
+    return f"{prefix}dt={day}/{hash_prefix}/{name}"
+
+
+# Record in the job index table where the objects of the jobs are saved: one item per Job_ID and Kind
+# ("Preprocessed" or "Labeled") with the object Key and, for newline-delimited objects, the Line of the job.
+# Returns False if the index could not be written
+def _indexJobObjects(table_name: str, entries: list, dynamodb=None):
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
+    try:
+        with dynamodb.Table(table_name).batch_writer(overwrite_by_pkeys=['Job_ID', 'Kind']) as batch:
+            for entry in entries:
+                batch.put_item(Item=entry)
+        return True
+
+    except Exception as e:
+        print(f"Error writing job index: {e}")
+        return False
+
+
+# Point the job index entries of compacted jobs to their shard: each entry has Job_ID, Kind, the Old_key of the
+# per-job object and the new Key and Line. Entries already pointing elsewhere (e.g. to a newer object) are left
+# as they are. Returns the set of the old keys whose entries could not be updated
+def _repointJobIndex(table_name: str, entries: list, dynamodb=None):
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
+    table = dynamodb.Table(table_name)
+    failed_keys = set()
+
+    for entry in entries:
+        try:
+            table.update_item(
+                Key = {'Job_ID': entry['Job_ID'], 'Kind': entry['Kind']},
+                UpdateExpression = "SET #key = :key, #line = :line",
+                ConditionExpression = "#key = :old_key",
+                ExpressionAttributeNames = {'#key': 'Key', '#line': 'Line'},
+                ExpressionAttributeValues = {':key': entry['Key'], ':line': entry['Line'], ':old_key': entry['Old_key']}
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+        except Exception as e:
+            print(f"Error updating job index: {e}")
+            failed_keys.add(entry['Old_key'])
+
+    return failed_keys
+
+
+# List the sub-prefixes (up to the next "/") under a prefix of the specified S3 bucket
+def _listPrefixesInS3Bucket(bucket_name: str, prefix: str, s3_client=None):
+    s3_client = s3_client or _getAWSClient('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            yield common_prefix['Prefix']
+
+
+# List the objects under a prefix of the specified S3 bucket. Yields the Key, Size and LastModified of each object.
+# With a delimiter, the objects in the sub-prefixes are not listed
+def _listObjectsInS3Bucket(bucket_name: str, prefix: str, s3_client=None, delimiter: str = None):
+    s3_client = s3_client or _getAWSClient('s3')
+    options = {'Delimiter': delimiter} if delimiter else {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, **options):
+        yield from page.get('Contents', [])
+
+
+# Delete objects from the specified S3 bucket with DeleteObjects, up to 1000 keys per call.
+# Returns the list of the keys not deleted
+def _deleteObjectsFromS3Bucket(bucket_name: str, keys: list, s3_client=None):
+    s3_client = s3_client or _getAWSClient('s3')
+    failed_keys = []
+
+    for i in range(0, len(keys), 1000):
+        batch = keys[i:i + 1000]
+        try:
+            response = s3_client.delete_objects(
+                Bucket = bucket_name,
+                Delete = {'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+        except Exception as e:
+            print(f"Error deleting objects from S3: {e}")
+            failed_keys.extend(batch)
+            continue
+
+        for error in response.get('Errors', []):
+            print(f"Error deleting {error.get('Key')} from S3: {error.get('Message')}")
+            failed_keys.append(error['Key'])
+
+    return failed_keys
+
+
+# Check if an object with the given key exists in the specified S3 bucket
+def _checkIfObjectExistsInS3Bucket(bucket_name: str, key: str, s3_client=None):
+    s3_client = s3_client or _getAWSClient('s3')
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        return True
+
+    except Exception as e:
+        return False
+
+
+# Read the object with the given key from the specified S3 bucket. Returns its content as a string
+def _readObjectFromS3Bucket(bucket_name: str, key: str, s3_client=None):
+    s3_client = s3_client or _getAWSClient('s3')
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+        return response['Body'].read().decode('utf-8')
+
+    except Exception as e:
+        print(f"Error reading object from S3: {e}")
+        return None
+
+
+# Claim-check: a job larger than threshold bytes is saved in the S3 bucket and replaced by a small pointer,
+# so it fits in the 256 KB limit of SNS and SQS. Returns the message to publish, or None if the save failed
+def _applyClaimCheck(bucket_name: str, job_id: str, job: str, threshold: int):
+    if len(job.encode('utf-8')) <= threshold:
+        return job
+
+    key = f"Claim-check/{job_id}.json"
+    if not _saveJobToS3Bucket(bucket_name, job, key):
+        return None
+
+    print(f"Job {job_id} offloaded to S3 ({len(job.encode('utf-8'))} bytes)")
+    return json.dumps({"Claim_check": {"Bucket": bucket_name, "Key": key}})
+
+
+# Replace a claim-check pointer with the job it points to. Other messages are returned as they are.
+# Returns None if the job could not be read from S3
+def _resolveClaimCheck(message: str):
+    # Pointers are tiny, there is no need to parse large messages to recognize them
+    if len(message) > 1024:
+        return message
+
+    try:
+        pointer = json.loads(message).get("Claim_check")
+    except (json.JSONDecodeError, AttributeError):
+        return message
+
+    if not pointer:
+        return message
+
+    return _readObjectFromS3Bucket(pointer["Bucket"], pointer["Key"])
\ No newline at end of file
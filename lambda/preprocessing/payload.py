@@ -0,0 +1,118 @@
+import sys
+import base64
+import hashlib
+from array import array
+
+
+# Compact wire format of the tokens of a preprocessed job, sent through SNS and SQS:
+#
+#   "Tokens": {
+#       "Version": 1,
+#       "Tokenizer": "<tokenizer name>@<hash of the vocabulary>",
+#       "Count": <number of tokens>,
+#       "Ids": base64 of the vocabulary ids, little-endian "Ids_type" integers,
+#       "Offsets": base64 of 2 little-endian "Offsets_type" integers per token,
+#       "Offsets_encoding": "delta" or "absolute",
+#       "Windows": [[first token, number of tokens], ...]
+#   }
+#
+# "delta" offsets are (characters between the end of the previous token and the start of this one,
+# token length) pairs, "absolute" offsets are (start, end) pairs in the scraped job description.
+# Windows are slices of the ids, each one ready for the model once [CLS] and [SEP] are added.
+#
+# To decode a job: _decodeTokenPayload gives back ids, offsets and windows. The token strings
+# come from the vocabulary of the tokenizer, saved by the preprocessing lambda in the S3 bucket
+# under _vocabularyKey(tag): token = vocabulary[id].
+
+PAYLOAD_VERSION = 1
+
+# Array typecodes of the unsigned integer types, from the smallest
+_INTEGER_TYPES = {"uint8": "B", "uint16": "H", "uint32": "I"}
+
+
+# Identify the tokenizer by name and vocabulary, so a payload is never decoded with another vocabulary
+def _tokenizerTag(tokenizer_name: str, vocabulary: list):
+    vocabulary_hash = hashlib.sha256("\n".join(vocabulary).encode()).hexdigest()[:12]
+    return f"{tokenizer_name}@{vocabulary_hash}"
+
+
+# S3 key where the vocabulary of the tokenizer with the given tag is saved
+def _vocabularyKey(tokenizer_tag: str):
+    return f"Tokenizers/{tokenizer_tag}.json"
+
+
+# Pack the integers with the smallest unsigned type that holds them. Returns the type name and the base64 text
+def _packIntegers(values: list):
+    largest = max(values, default=0)
+    for type_name, typecode in _INTEGER_TYPES.items():
+        if largest < 256 ** array(typecode).itemsize:
+            packed = array(typecode, values)
+            if sys.byteorder == "big":
+                packed.byteswap()
+            return type_name, base64.b64encode(packed.tobytes()).decode("ascii")
+
+    raise ValueError(f"Value {largest} does not fit in 32 bits")
+
+
+# Unpack the base64 text produced by _packIntegers
+def _unpackIntegers(type_name: str, text: str):
+    packed = array(_INTEGER_TYPES[type_name])
+    packed.frombytes(base64.b64decode(text))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist()
+
+
+# Build the compact payload of a job from its token windows (see _tokenizeTexts in preprocessing)
+def _encodeTokenPayload(tokenizer_tag: str, windows: list):
+    ids, offsets, spans = [], [], []
+
+    # Overlapping tokens are sent once: each window keeps only the tokens after the ones already taken
+    for window in windows:
+        skip = len(ids) - window["Start"]
+        ids.extend(window["Ids"][skip:])
+        offsets.extend(window["Offsets"][skip:])
+        spans.append([window["Start"], len(window["Ids"])])
+
+    deltas, previous_end = [], 0
+    for start, end in offsets:
+        deltas.extend([start - previous_end, end - start])
+        previous_end = end
+
+    if min(deltas, default=0) >= 0:
+        offsets_encoding, offset_values = "delta", deltas
+    else:
+        offsets_encoding, offset_values = "absolute", [value for offset in offsets for value in offset]
+
+    ids_type, packed_ids = _packIntegers(ids)
+    offsets_type, packed_offsets = _packIntegers(offset_values)
+
+    return {
+        "Version": PAYLOAD_VERSION,
+        "Tokenizer": tokenizer_tag,
+        "Count": len(ids),
+        "Ids": packed_ids,
+        "Ids_type": ids_type,
+        "Offsets": packed_offsets,
+        "Offsets_type": offsets_type,
+        "Offsets_encoding": offsets_encoding,
+        "Windows": spans
+    }
+
+
+# Decode the compact payload of a job. Returns the token ids, their (start, end) offsets and the windows
+def _decodeTokenPayload(payload: dict):
+    ids = _unpackIntegers(payload["Ids_type"], payload["Ids"])
+    values = _unpackIntegers(payload["Offsets_type"], payload["Offsets"])
+
+    offsets = []
+    if payload["Offsets_encoding"] == "delta":
+        previous_end = 0
+        for i in range(0, len(values), 2):
+            start = previous_end + values[i]
+            previous_end = start + values[i + 1]
+            offsets.append((start, previous_end))
+    else:
+        offsets = [(values[i], values[i + 1]) for i in range(0, len(values), 2)]
+
+    return ids, offsets, payload["Windows"]
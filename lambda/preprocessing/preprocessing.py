@@ -1,116 +1,177 @@
 import os
 import json
 import awsutils as aws_ut
+import payload as payload_ut
 from transformers import AutoTokenizer
 
 
-# Predict how many tokens the text will generate
-def _predictTokenCount(tokenizer: AutoTokenizer, text: str):
-    estimated_tokens = len(text) // 3  
-    return estimated_tokens
+# Tokenizer baked into the image by the Dockerfile. It is loaded once per container, at cold start,
+# and never downloaded: local_files_only fails fast if the files are missing from the image
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "bert-base-multilingual-uncased")
+tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, local_files_only=True)
 
+# Vocabulary (token of each id) and tag identifying the tokenizer in the compact payloads
+TOKENIZER_NAME = os.getenv("TOKENIZER_NAME", "bert-base-multilingual-uncased")
+vocabulary = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+tokenizer_tag = payload_ut._tokenizerTag(TOKENIZER_NAME, vocabulary)
+vocabulary_published = False
 
-# Calculate optimal number of words per chunk to stay under token limit
-def _calculateWordsPerChunk(max_tokens: int):
-    words_per_chunk = max_tokens // 2   # Estimate 2 tokens per word
-    words_per_chunk = int(words_per_chunk * 0.9)  # Add safety margin
-    
-    return words_per_chunk
+# Preprocessed jobs larger than this are offloaded to S3 and published as a claim-check pointer
+CLAIM_CHECK_THRESHOLD_BYTES = int(os.getenv("CLAIM_CHECK_THRESHOLD_BYTES", "200000"))
 
 
-# Divides the text in chunks containing a certain number of words
-def _chunkTextByWordCount(text: str, words_per_chunk: int):
-    words = text.split()
-    chunks = []
-    
-    # Create chunks of specified word count
-    for i in range(0, len(words), words_per_chunk):
-        chunk_words = words[i:i + words_per_chunk]
-        chunk_text = ' '.join(chunk_words)
-        chunks.append(chunk_text)
-    
-    return chunks
+# Tokens shared by two consecutive windows, so every token is seen with some context on both sides
+TEXT_WINDOW_OVERLAP = int(os.getenv("TEXT_WINDOW_OVERLAP", "64"))
 
 
-def _tokenizeText(tokenizer: AutoTokenizer, text: str, max_tokens: int):
-    estimated_tokens = _predictTokenCount(tokenizer, text)
-    print(f"Estimated tokens: {estimated_tokens}")
-    
-    if estimated_tokens <= max_tokens:
-        tokens = tokenizer.tokenize(text)
-        print(f"Text tokenized directly: {len(tokens)} tokens")
-        return tokens
-    
-    # Text exceeds limit, calculate optimal words per chunk
-    words_per_chunk = _calculateWordsPerChunk(max_tokens)
-    print(f"Text exceeds {max_tokens} tokens, dividing into chunks of {words_per_chunk} words each")
-    
-    chunks = _chunkTextByWordCount(text, words_per_chunk)
-    print(f"Text divided into {len(chunks)} chunks")
-    
-    all_tokens = []
-    
-    for i, chunk in enumerate(chunks):
-        chunk_tokens = tokenizer.tokenize(chunk)
-        all_tokens.extend(chunk_tokens)
-        
-        if len(chunk_tokens) > max_tokens:
-            print(f"WARNING: Chunk {i+1} has {len(chunk_tokens)} tokens (exceeds {max_tokens})")
+# Split the texts of all the jobs into token windows with a single call to the fast tokenizer.
+# Windows hold at most max_tokens tokens including the special tokens the model adds ([CLS], [SEP]),
+# and consecutive windows share `overlap` tokens. Token counts are exact and no text is tokenized twice.
+# Returns, for each text, the list of its windows: the token ids, their character offsets in the text
+# and Start, the position of the first token of the window in the whole token sequence of the text
+def _tokenizeTexts(tokenizer: AutoTokenizer, texts: list, max_tokens: int, overlap: int = TEXT_WINDOW_OVERLAP):
+    window_size = max_tokens - tokenizer.num_special_tokens_to_add()
+    encodings = tokenizer(
+        texts,
+        add_special_tokens = False,
+        truncation = True,
+        max_length = window_size,
+        stride = overlap,
+        return_overflowing_tokens = True,
+        return_offsets_mapping = True
+    )
+
+    all_windows = [[] for _ in texts]
+    for window, text_index in enumerate(encodings["overflow_to_sample_mapping"]):
+        windows = all_windows[text_index]
+
+        # Each overflowing window starts with the last `overlap` tokens of the previous one
+        start = 0
+        if windows:
+            start = windows[-1]["Start"] + len(windows[-1]["Ids"]) - overlap
+
+        windows.append({
+            "Start": start,
+            "Ids": encodings["input_ids"][window],
+            "Offsets": [list(offset) for offset in encodings["offset_mapping"][window]]
+        })
+
+    print(f"Tokenized {len(texts)} texts in {len(encodings['input_ids'])} windows")
+    return all_windows
+
+
+# Save the vocabulary of the tokenizer in the S3 bucket, once per container, so the consumers of the
+# compact payloads can decode the token ids. The vocabulary is written only if no lambda did it before;
+# if the save fails, it is tried again on the next invocation
+def _publishVocabulary(bucket_name: str):
+    global vocabulary_published
+    if vocabulary_published or not bucket_name:
+        return
+
+    key = payload_ut._vocabularyKey(tokenizer_tag)
+    if not aws_ut._checkIfObjectExistsInS3Bucket(bucket_name, key):
+        if not aws_ut._saveJobToS3Bucket(bucket_name, json.dumps(vocabulary, ensure_ascii=False), key):
+            print(f"Vocabulary of {tokenizer_tag} not saved to S3")
+            return
+        print(f"Vocabulary of {tokenizer_tag} saved to S3")
+
+    vocabulary_published = True
+
+
+# Tokenize the jobs received and publish them to the SNS topic.
+# Messages is a list of (message_id, body) pairs. Returns the ids of the messages that failed
+def _processJobs(messages: list, sns_topic_arn: str, bucket_name: str, text_max_tokens: int):
+    failed_ids = []
+    jobs = []
+
+    for message_id, job in messages:
+        try:
+            job_data = json.loads(job)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON: {e}")
+            failed_ids.append(message_id)
+            continue
+
+        jobs.append((message_id, job_data))
+
+    if not jobs:
+        return failed_ids
+
+    descriptions = [job_data.get("Description") or "" for _, job_data in jobs]
+    jobs_windows = _tokenizeTexts(tokenizer, descriptions, text_max_tokens)
+    jobs_to_publish = []
+
+    for (message_id, job_data), job_windows in zip(jobs, jobs_windows):
+        filtered_job = {
+            "Job_ID": job_data.get("Job_ID"),
+            "Title": job_data.get("Title"),
+            "Company": job_data.get("Company_name"),
+            "Tokens": payload_ut._encodeTokenPayload(tokenizer_tag, job_windows)
+        }
+        filtered_json_string = json.dumps(filtered_job, ensure_ascii=False)
+        filtered_json_string = aws_ut._applyClaimCheck(bucket_name, filtered_job["Job_ID"], filtered_json_string, CLAIM_CHECK_THRESHOLD_BYTES)
+
+        if filtered_json_string is None:
+            failed_ids.append(message_id)
         else:
-            print(f"Chunk {i+1}: {len(chunk_tokens)} tokens ({len(chunk.split())} words)")
-    
-    total_tokens = len(all_tokens)
-    print(f"Total tokens after chunking: {total_tokens}")
-    
-    return all_tokens
+            jobs_to_publish.append((message_id, filtered_json_string))
+
+    published_ids = aws_ut._writeJobsToSNSTopic(sns_topic_arn, jobs_to_publish)
+    failed_ids.extend(message_id for message_id, _ in jobs_to_publish if message_id not in published_ids)
 
+    return failed_ids
 
 
+# Invoked by the SQS event source mapping with a batch of up to 10 messages: only the messages reported
+# in batchItemFailures return to the queue, the others are deleted by Lambda.
+# Invoked without records (e.g. manually), the function reads and deletes the messages by itself
 def lambda_handler(event, context):
     sns_topic_arn = os.getenv('SNS_TOPIC_ARN')
-    sqs_queue_url = aws_ut._retrieveSQSQueueUrl(os.getenv("DEDUPLICATED_JOBS_QUEUE_NAME"))
-    tokenizer = AutoTokenizer.from_pretrained("bert-base-multilingual-uncased")
+    s3_bucket_name = os.getenv('S3_BUCKET_NAME')
     text_max_tokens = 512
 
-    
+    _publishVocabulary(s3_bucket_name)
+
+    records = (event or {}).get('Records')
+    if records is not None:
+        messages = [(record['messageId'], record.get('body')) for record in records]
+        message_ids = [message_id for message_id, _ in messages]
+        try:
+            failed_ids = _processJobs(messages, sns_topic_arn, s3_bucket_name, text_max_tokens)
+        except Exception as e:
+            print(f"Error processing messages from SQS: {e}")
+            failed_ids = message_ids
+
+        print(f"Processed {len(message_ids) - len(failed_ids)} messages, {len(failed_ids)} failed")
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]}
+
+    sqs_queue_url = aws_ut._retrieveSQSQueueUrl(os.getenv("DEDUPLICATED_JOBS_QUEUE_NAME"))
     if not sqs_queue_url:
         print("SQS queue URL not found")
         return
     
     try:
-        messages = aws_ut._readJobFromSQSQueue(sqs_queue_url)
+        messages = aws_ut._readJobFromSQSQueue(sqs_queue_url, max_messages=10)
         if not messages:
             print("No messages in the queue")
             return
         
+        jobs = []
         for message in messages:
             receipt_handle = message.get('ReceiptHandle')
             job = message.get('Body')
             if not job or not receipt_handle:
                 print("Message body or receipt handle is empty")
                 continue
-            
-            try:
-                job_data = json.loads(job)
-                job_description = job_data.get("Description")
-                job_tokenized = _tokenizeText(tokenizer, job_description, text_max_tokens)
-                filtered_job = {
-                    "Job_ID": job_data.get("Job_ID"),
-                    "Title": job_data.get("Title"),
-                    "Company": job_data.get("Company_name"),
-                    "Description": job_tokenized
-                }
-                filtered_json_string = json.dumps(filtered_job, ensure_ascii=False)
-                
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON: {e}")
-                continue
 
-            aws_ut._writeJobToSNSTopic(sns_topic_arn, filtered_json_string)
-            
-            aws_ut._deleteJobFromSQSQueue(sqs_queue_url, receipt_handle)
-            
-            print("Message processed and deleted from the queue")
+            jobs.append((receipt_handle, job))
+
+        failed_handles = _processJobs(jobs, sns_topic_arn, s3_bucket_name, text_max_tokens)
+
+        # A message is deleted only if its job was published
+        published_handles = [receipt_handle for receipt_handle, _ in jobs if receipt_handle not in failed_handles]
+        not_deleted = aws_ut._deleteJobsFromSQSQueue(sqs_queue_url, published_handles)
+        print(f"{len(published_handles) - len(not_deleted)} messages processed and deleted from the queue")
 
     except Exception as e:
         print(f"Error processing messages from SQS: {e}")
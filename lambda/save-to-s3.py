@@ -1,10 +1,65 @@
 import os
 import json
 import preprocessing.awsutils as aws_ut
-from datetime import datetime
 
+
+# Most labeled jobs accepted in a single submission
+MAX_JOBS_PER_SUBMISSION = 50
+
+
+# Save the labeled jobs held by the annotator, index them and delete their messages from the queue.
+# Each job is saved under its Job_ID, so saving it again the same day overwrites the same object.
+# Returns one result per job: "saved", "conflict" if the lease is held by another annotator,
+# "invalid" if the job has no id, or "error"
+def _saveLabeledJobs(labeled_jobs: list, bucket_name: str, queue_url: str, job_leases_table_name: str, job_index_table_name: str):
+    results = [None] * len(labeled_jobs)
+    objects, leased = [], []
+
+    for i, labeled_job in enumerate(labeled_jobs):
+        job_id = labeled_job.get("jobId") if isinstance(labeled_job, dict) else None
+        if not job_id:
+            results[i] = {'jobId': job_id, 'status': 'invalid'}
+            continue
+
+        # Only the annotator holding the lease of the job can save its labels
+        if not aws_ut._readJobLease(job_leases_table_name, job_id, labeled_job.get("leaseId")):
+            print(f"Lease of job {job_id} not held")
+            results[i] = {'jobId': job_id, 'status': 'conflict'}
+            continue
+
+        key = aws_ut._partitionedObjectKey("Labeled-data/", f"{job_id}.json")
+        objects.append((key, json.dumps(labeled_job)))
+        leased.append((i, key, labeled_job))
+
+    saved_keys = aws_ut._saveJobsToS3Bucket(bucket_name, objects)
+
+    if job_index_table_name:
+        aws_ut._indexJobObjects(job_index_table_name, [
+            {'Job_ID': labeled_job["jobId"], 'Kind': 'Labeled', 'Key': key}
+            for _, key, labeled_job in leased if key in saved_keys
+        ])
+
+    for i, key, labeled_job in leased:
+        job_id = labeled_job["jobId"]
+        if key not in saved_keys:
+            results[i] = {'jobId': job_id, 'status': 'error', 'error': 'Failed to save labels'}
+            continue
+
+        # The job is done: its message is deleted from the queue
+        if not aws_ut._releaseJobLease(job_leases_table_name, queue_url, job_id, labeled_job.get("leaseId"), done=True):
+            print(f"Labels of job {job_id} saved, but its lease was lost before the message was deleted")
+        results[i] = {'jobId': job_id, 'status': 'saved'}
+
+    return results
+
+
+# Save labeled jobs. The body is a single labeled job, or {"jobs": [...]} to submit a batch of jobs
+# in one request; a batch always answers 200 with the result of each job
 def lambda_handler(event, context):
     s3_bucket_name = os.getenv('S3_BUCKET_NAME')
+    sqs_queue_url = os.getenv('PREPROCESSED_JOBS_QUEUE_URL')
+    job_leases_table_name = os.getenv('JOB_LEASES_TABLE_NAME')
+    job_index_table_name = os.getenv('JOB_INDEX_TABLE_NAME')
     cors_headers = {
         'Access-Control-Allow-Origin': os.getenv('CORS_ORIGIN'),
         'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
@@ -19,19 +74,58 @@ def lambda_handler(event, context):
             'headers': cors_headers,
             'body': json.dumps({'error': 'S3 bucket name not configured.'})
         }
+
+    if not sqs_queue_url or not job_leases_table_name:
+        print("Queue URL or job leases table name not defined")
+        return {
+            'statusCode': 500,
+            'headers': cors_headers,
+            'body': json.dumps({'error': 'Job leases not configured.'})
+        }
     
     try:
-        labeled_job_post = event["body"]
+        json_body = json.loads(event["body"])
+        batch = isinstance(json_body, dict) and isinstance(json_body.get("jobs"), list)
+        labeled_jobs = json_body["jobs"] if batch else [json_body]
 
-        json_labeled_job_post = json.loads(labeled_job_post)
-        job_title = json_labeled_job_post.get("title")
-        timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+        if len(labeled_jobs) > MAX_JOBS_PER_SUBMISSION:
+            return {
+                'statusCode': 400,
+                'headers': cors_headers,
+                'body': json.dumps({'error': f'At most {MAX_JOBS_PER_SUBMISSION} jobs can be submitted at once.'})
+            }
 
-        filename = f"{job_title}-{timestamp}"
+        results = _saveLabeledJobs(labeled_jobs, s3_bucket_name, sqs_queue_url, job_leases_table_name, job_index_table_name)
 
-        s3_key = f"Labeled-data/{filename}.json"
+        if batch:
+            return {
+                'statusCode': 200,
+                'headers': cors_headers,
+                'body': json.dumps({
+                    'saved': sum(result['status'] == 'saved' for result in results),
+                    'results': results
+                })
+            }
 
-        aws_ut._saveJobToS3Bucket(s3_bucket_name, labeled_job_post, s3_key)
+        result = results[0]
+        if result['status'] == 'conflict':
+            return {
+                'statusCode': 409,
+                'headers': cors_headers,
+                'body': json.dumps({'error': 'The lease of the job expired and it was checked out by another annotator.'})
+            }
+        if result['status'] == 'invalid':
+            return {
+                'statusCode': 400,
+                'headers': cors_headers,
+                'body': json.dumps({'error': 'Missing jobId.'})
+            }
+        if result['status'] == 'error':
+            return {
+                'statusCode': 500,
+                'headers': cors_headers,
+                'body': json.dumps({'error': result['error']})
+            }
 
         return {
             'statusCode': 200,
@@ -39,9 +133,9 @@ def lambda_handler(event, context):
         }
 
     except Exception as e:
-        print(f"Error processing SNS message: {e}")
+        print(f"Error saving labeled jobs: {e}")
         return {
             'statusCode': 500,
             'headers': cors_headers,
             'body': json.dumps({'error': f'Failed to save labels: {str(e)}'})
-        }
\ No newline at end of file
+        }
@@ -1,31 +1,51 @@
 import os
 import json
+import uuid
 import preprocessing.awsutils as aws_ut
-from datetime import datetime
 
+
+# Invoked by the SQS event source mapping of the archive queue, subscribed to the SNS topic, with batches
+# of preprocessed jobs. The whole batch is saved as a single newline-delimited JSON object; only the
+# messages reported in batchItemFailures return to the queue. The line of each job is recorded in the job index
 def lambda_handler(event, context):
     s3_bucket_name = os.getenv('S3_BUCKET_NAME')
+    job_index_table_name = os.getenv('JOB_INDEX_TABLE_NAME')
+    records = event.get('Records', [])
     
     if not s3_bucket_name:
         print("Bucket name not defined")
-        return
-    
-    try:
-        for record in event['Records']:
-            sns_message = record["Sns"]["Message"]
-            json_message = json.loads(sns_message)            
-            job_title = json_message.get("Title")
-            timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+        return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in records]}
 
-            filename = f"{job_title}-{timestamp}"
+    lines, job_ids, saved_ids, failed_ids = [], [], [], []
+    for record in records:
+        try:
+            # Large jobs arrive as a claim-check pointer to the job saved in S3
+            message = aws_ut._resolveClaimCheck(record['body'])
+            if message is None:
+                failed_ids.append(record['messageId'])
+                continue
 
-            s3_key = f"Preprocessed-posts/{filename}.json"
+            # One job per line
+            job = json.loads(message)
+            lines.append(json.dumps(job, separators=(',', ':'), ensure_ascii=False))
+            job_ids.append(job.get('Job_ID'))
+            saved_ids.append(record['messageId'])
 
-            aws_ut._saveJobToS3Bucket(s3_bucket_name, sns_message, s3_key)
+        except Exception as e:
+            print(f"Error processing message {record.get('messageId')}: {e}")
+            failed_ids.append(record['messageId'])
 
-        return
+    if lines:
+        s3_key = aws_ut._partitionedObjectKey("Preprocessed-posts/", f"{uuid.uuid4().hex}.jsonl")
 
-    
-    except Exception as e:
-        print(f"Error processing SNS message: {e}")
-        return None
\ No newline at end of file
+        if not aws_ut._saveJobToS3Bucket(s3_bucket_name, "\n".join(lines) + "\n", s3_key, content_type="application/x-ndjson"):
+            failed_ids.extend(saved_ids)
+
+        elif job_index_table_name:
+            aws_ut._indexJobObjects(job_index_table_name, [
+                {'Job_ID': job_id, 'Kind': 'Preprocessed', 'Key': s3_key, 'Line': line}
+                for line, job_id in enumerate(job_ids) if job_id
+            ])
+
+    print(f"Saved {len(records) - len(failed_ids)} jobs, {len(failed_ids)} failed")
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]}
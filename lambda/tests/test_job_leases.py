@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import importlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-north-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+import preprocessing.awsutils as aws_ut
+
+fetch_from_queue = importlib.import_module("fetch-from-queue")
+job_lease = importlib.import_module("job-lease")
+save_to_s3 = importlib.import_module("save-to-s3")
+
+
+BUCKET_NAME = "labeling-platform-test"
+
+
+# Check out, renew, release and save of the job leases, against the queue, the tables and the bucket of moto
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class TestJobLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        aws_ut._aws_clients.clear()
+
+        self.sqs = boto3.client("sqs")
+        self.queue_url = self.sqs.create_queue(QueueName="preprocessed-jobs")["QueueUrl"]
+        boto3.client("s3").create_bucket(Bucket=BUCKET_NAME, CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_DEFAULT_REGION"]})
+
+        dynamodb = boto3.resource("dynamodb")
+        self.leases = dynamodb.create_table(
+            TableName = "job-leases",
+            KeySchema = [{"AttributeName": "Job_ID", "KeyType": "HASH"}],
+            AttributeDefinitions = [{"AttributeName": "Job_ID", "AttributeType": "S"}],
+            BillingMode = "PAY_PER_REQUEST"
+        )
+        dynamodb.create_table(
+            TableName = "job-index",
+            KeySchema = [{"AttributeName": "Job_ID", "KeyType": "HASH"}, {"AttributeName": "Kind", "KeyType": "RANGE"}],
+            AttributeDefinitions = [{"AttributeName": "Job_ID", "AttributeType": "S"}, {"AttributeName": "Kind", "AttributeType": "S"}],
+            BillingMode = "PAY_PER_REQUEST"
+        )
+
+        self.environ = dict(os.environ)
+        os.environ.update({
+            "PREPROCESSED_JOBS_QUEUE_URL": self.queue_url,
+            "JOB_LEASES_TABLE_NAME": "job-leases",
+            "JOB_INDEX_TABLE_NAME": "job-index",
+            "S3_BUCKET_NAME": BUCKET_NAME,
+            "FETCH_TIME_BUDGET_SECONDS": "1"
+        })
+        fetch_from_queue.FETCH_TIME_BUDGET_SECONDS = 1
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        aws_ut._aws_clients.clear()
+        self.mock.stop()
+
+    def _sendJob(self, job_id: str):
+        body = {"Job_ID": job_id, "Title": "Backend Developer", "Company": "ACME", "Description": ["back", "##end"]}
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body))
+
+    def _fetchJobs(self, count: int = 10):
+        response = fetch_from_queue.lambda_handler({"queryStringParameters": {"count": str(count)}}, None)
+        self.assertEqual(response["statusCode"], 200)
+        return json.loads(response["body"])["jobs"]
+
+    def _updateLeases(self, method: str, job: dict, lease_id: str = None):
+        body = {"leases": [{"jobId": job["Job_ID"], "leaseId": lease_id or job["Lease_ID"]}]}
+        return json.loads(job_lease.lambda_handler({"httpMethod": method, "body": json.dumps(body)}, None)["body"])
+
+    def _saveJob(self, job: dict):
+        body = {"jobId": job["Job_ID"], "leaseId": job["Lease_ID"], "labels": []}
+        return save_to_s3.lambda_handler({"body": json.dumps(body)}, None)
+
+    def _readLease(self, job_id: str):
+        return self.leases.get_item(Key={"Job_ID": job_id}, ConsistentRead=True).get("Item")
+
+    def _countMessages(self):
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl = self.queue_url,
+            AttributeNames = ["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"]
+        )["Attributes"]
+        return int(attributes["ApproximateNumberOfMessages"]) + int(attributes["ApproximateNumberOfMessagesNotVisible"])
+
+    def test_checkout_leases_the_message(self):
+        self._sendJob("1")
+        jobs = self._fetchJobs()
+
+        self.assertEqual([job["Job_ID"] for job in jobs], ["1"])
+        self.assertEqual(jobs[0]["Tokens"], ["back", "##end"])
+
+        lease = self._readLease("1")
+        self.assertEqual(lease["Lease_ID"], jobs[0]["Lease_ID"])
+        self.assertTrue(lease["Message_ID"])
+        self.assertLessEqual(int(lease["Lease_expires"]), int(time.time()) + fetch_from_queue.JOB_LEASE_SECONDS)
+
+        # Hidden while the lease lasts
+        self.assertEqual(self._fetchJobs(), [])
+        self.assertEqual(self._countMessages(), 1)
+
+    def test_renew_extends_only_the_lease_held(self):
+        self._sendJob("1")
+        job = self._fetchJobs()[0]
+        self.leases.update_item(Key={"Job_ID": "1"}, UpdateExpression="SET Lease_expires = :expires", ExpressionAttributeValues={":expires": int(time.time()) + 10})
+
+        self.assertEqual(self._updateLeases("PUT", job), {"renewed": ["1"], "lost": [], "leaseSeconds": job_lease.JOB_LEASE_SECONDS})
+        self.assertGreater(int(self._readLease("1")["Lease_expires"]), int(time.time()) + 10)
+
+        self.assertEqual(self._updateLeases("PUT", job, lease_id="another-lease")["lost"], ["1"])
+
+    def test_release_gives_the_job_back(self):
+        self._sendJob("1")
+        job = self._fetchJobs()[0]
+
+        self.assertEqual(self._updateLeases("DELETE", job)["released"], ["1"])
+        self.assertIsNone(self._readLease("1"))
+
+        jobs = self._fetchJobs()
+        self.assertEqual([job["Job_ID"] for job in jobs], ["1"])
+        self.assertNotEqual(jobs[0]["Lease_ID"], job["Lease_ID"])
+
+    def test_save_deletes_the_message(self):
+        self._sendJob("1")
+        job = self._fetchJobs()[0]
+
+        response = self._saveJob(job)
+        self.assertEqual(response["statusCode"], 200)
+        self.assertIsNone(self._readLease("1"))
+        self.assertEqual(self._countMessages(), 0)
+
+        # The lease is gone: saving again is a conflict
+        self.assertEqual(self._saveJob(job)["statusCode"], 409)
+
+    def test_leased_message_received_again_is_kept(self):
+        self._sendJob("1")
+        job = self._fetchJobs()[0]
+        receipt_handle = self._readLease("1")["Receipt_handle"]
+
+        # The message becomes visible while its lease is still valid
+        self.sqs.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle, VisibilityTimeout=0)
+        self.assertEqual(self._fetchJobs(), [])
+        self.assertEqual(self._countMessages(), 1)
+
+        lease = self._readLease("1")
+        self.assertEqual(lease["Lease_ID"], job["Lease_ID"])
+        self.assertNotEqual(lease["Receipt_handle"], receipt_handle)
+        self.assertEqual(self._fetchJobs(), [])
+
+        # The annotator holding the lease can still save the job, deleting the message
+        self.assertEqual(self._saveJob(job)["statusCode"], 200)
+        self.assertEqual(self._countMessages(), 0)
+
+    def test_duplicate_message_is_deleted(self):
+        self._sendJob("1")
+        self._sendJob("1")
+        jobs = self._fetchJobs()
+
+        self.assertEqual([job["Job_ID"] for job in jobs], ["1"])
+        self.assertEqual(self._countMessages(), 1)
+
+        self.assertEqual(self._saveJob(jobs[0])["statusCode"], 200)
+        self.assertEqual(self._countMessages(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
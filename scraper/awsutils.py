@@ -1,5 +1,8 @@
 import os
+import time
+import threading
 import boto3
+from botocore.config import Config
 import hashlib
 import json
 from dotenv import load_dotenv
@@ -31,25 +34,41 @@ def _setupAWSSession():
 _setupAWSSession()
 
 
-try:
-    print("Initializing AWS services...")
-    dynamodb = boto3.resource('dynamodb')
-    sqs_client = boto3.client('sqs')
-    sns_client = boto3.client('sns')
-    
-    # Test the connection
-    session = boto3.Session()
-    print(f"AWS session region: {session.region_name}")
-    print("AWS services initialized successfully")
-    
-except Exception as e:
-    print(f"ERROR: Failed to initialize AWS services: {e}")
-    raise
+# Connections kept open to each AWS service, enough for the threads calling it at the same time
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "10"))
+
+# Configuration shared by all the clients: standard retry mode, with exponential backoff of throttled
+# and failed calls, and TCP keep-alive on the pooled connections, so they are reused between calls
+_aws_config = Config(
+    max_pool_connections = AWS_MAX_POOL_CONNECTIONS,
+    retries = {'mode': 'standard', 'max_attempts': 5},
+    tcp_keepalive = True
+)
+
+# Clients and resources created so far, by service
+_aws_clients = {}
+_aws_clients_lock = threading.Lock()
+
+
+# Return the client (or the resource) of an AWS service, created the first time it is needed and then reused.
+# Only the services actually called are initialized
+def _getAWSClient(service_name: str, resource: bool = False):
+    name = f"{service_name}-resource" if resource else service_name
+    if name in _aws_clients:
+        return _aws_clients[name]
+
+    with _aws_clients_lock:
+        if name not in _aws_clients:
+            factory = boto3.resource if resource else boto3.client
+            _aws_clients[name] = factory(service_name, config=_aws_config)
+
+    return _aws_clients[name]
 
 
 
 # Retrieve the DynamoDB table by table name
-def _retrieveDynamoDBTable(table_name: str, dynamodb=dynamodb):
+def _retrieveDynamoDBTable(table_name: str, dynamodb=None):
+    dynamodb = dynamodb or _getAWSClient('dynamodb', resource=True)
     try:
         table = dynamodb.Table(table_name)
         return table
@@ -59,46 +78,121 @@ def _retrieveDynamoDBTable(table_name: str, dynamodb=dynamodb):
         return None
 
 
-# Save the job object received into the DynamoDB table passed
-def _saveJobToDynamoDB(db_table, job: dict):
+# Save the job objects received into the DynamoDB table passed.
+# Items are written with BatchWriteItem, flushing 25 of them at a time
+def _saveJobsToDynamoDB(db_table, jobs: list, max_retries: int = 5):
+    jobs = list({job['Job_ID']: job for job in jobs}.values()) # BatchWriteItem refuses duplicated keys
+
     try:
-        db_table.put_item(Item=job)
-        return 
-    
+        for i in range(0, len(jobs), 25):
+            request = {
+                db_table.name: [{'PutRequest': {'Item': job}} for job in jobs[i:i + 25]]
+            }
+
+            for attempt in range(max_retries + 1):
+                response = db_table.meta.client.batch_write_item(RequestItems=request)
+
+                # Retry only the items DynamoDB could not write, backing off exponentially
+                request = response.get('UnprocessedItems')
+                if not request:
+                    break
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            else:
+                print(f"Unprocessed items left after {max_retries} retries")
+
     except Exception as e:
-        print(f"Error saving job to DynamoDB: {e}")
+        print(f"Error saving jobs to DynamoDB: {e}")
 
-    
-# Update the job adding the description field
-def _updateJobInDynamoDB(db_table, job: dict):
+
+# Check which of the jobs with the ids received already exist in the table passed.
+# Keys are read with BatchGetItem, 100 at a time. Returns a dict of the jobs found, by Job_ID
+def _checkIfJobsExist(db_table, job_ids: list, max_retries: int = 5):
+    found_jobs = {}
+    job_ids = list(dict.fromkeys(str(job_id) for job_id in job_ids)) # BatchGetItem refuses duplicated keys
+
+    try:
+        for i in range(0, len(job_ids), 100):
+            request = {
+                db_table.name: {
+                    'Keys': [{'Job_ID': job_id} for job_id in job_ids[i:i + 100]],
+                    'ProjectionExpression': 'Job_ID, Sent_to_queue'
+                }
+            }
+
+            for attempt in range(max_retries + 1):
+                response = db_table.meta.client.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(db_table.name, []):
+                    found_jobs[item['Job_ID']] = item
+
+                # Retry only the keys DynamoDB could not read, backing off exponentially
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            else:
+                print(f"Unprocessed keys left after {max_retries} retries")
+
+    except Exception as e:
+        print(f"Error checking jobs existence: {e}")
+
+    return found_jobs
+
+
+# Take the lease on the keyword for the worker, so no other worker crawls it at the same time.
+# The lease is granted if the keyword is free, belongs to a previous run, is already held by the
+# same worker or has expired. Returns whether the lease was granted and the checkpoint found before it
+def _claimCrawlKeyword(state_table, keyword: str, run_id: str, worker_id: str, lease_seconds: int):
+    now = int(time.time())
     try:
-        db_table.update_item(
-            Key = {'Job_ID': job['Job_ID']},
-            UpdateExpression = "SET Sent_to_queue = :val",
-            ExpressionAttributeValues ={
-                ':val': job['Sent_to_queue']
+        response = state_table.update_item(
+            Key = {'Keyword': keyword},
+            UpdateExpression = "SET Run_ID = :run, #owner = :owner, Lease_expires = :expires",
+            ConditionExpression = "attribute_not_exists(Keyword) OR Run_ID <> :run OR #owner = :owner OR Lease_expires < :now",
+            ExpressionAttributeNames = {'#owner': 'Owner'},
+            ExpressionAttributeValues = {
+                ':run': run_id,
+                ':owner': worker_id,
+                ':expires': now + lease_seconds,
+                ':now': now
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues = "ALL_OLD"
         )
-        return
+        return True, response.get('Attributes', {})
+
+    except state_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False, None
 
     except Exception as e:
-        print(f"Error updating job in DynamoDB: {e}")
+        # Without the state table the keyword is crawled from the beginning, as if there was no checkpoint
+        print(f"Error claiming crawl keyword: {e}")
+        return True, {}
 
 
-# Check if the job with the id received already exists in the table passed
-def _checkIfJobExists(db_table, job_id: str):
+# Save the crawl checkpoint of a keyword into the crawl state table, renewing the lease of its owner.
+# Checkpoints expire after a week. Returns False if the lease has been taken by another worker
+def _saveCrawlCheckpoint(state_table, checkpoint: dict):
     try:
-        response = db_table.get_item(Key={'Job_ID': str(job_id)})
-        return response.get('Item')
-    
+        item = dict(checkpoint)
+        item['ttl'] = int(time.time()) + 7 * 24 * 3600
+        state_table.put_item(
+            Item = item,
+            ConditionExpression = "#owner = :owner",
+            ExpressionAttributeNames = {'#owner': 'Owner'},
+            ExpressionAttributeValues = {':owner': item['Owner']}
+        )
+        return True
+
+    except state_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
     except Exception as e:
-        print(f"Error checking job existence: {e}")
-        return None 
+        print(f"Error saving crawl checkpoint: {e}")
+        return True
 
 
 # Retrieve the SQS queue by queue name
-def _retrieveSQSQueueUrl(queue_name: str, sqs_client=sqs_client):
+def _retrieveSQSQueueUrl(queue_name: str, sqs_client=None):
+    sqs_client = sqs_client or _getAWSClient('sqs')
     try:
         queue = sqs_client.get_queue_url(QueueName=queue_name)
         return queue.get('QueueUrl')
@@ -108,26 +202,77 @@ def _retrieveSQSQueueUrl(queue_name: str, sqs_client=sqs_client):
         return None
 
 
-# Write the job in the SQS queue
-def _writeJobToSQSQueue(sqs_queue, job: dict, sqs_client=sqs_client):
-    try:
+# Write the jobs in the SQS queue with SendMessageBatch, packing up to 10 messages or 256 KB per call.
+# Failed entries and entries whose MD5 does not correspond are retried alone.
+# Sent jobs are marked as sent. Returns the list of the jobs sent
+def _writeJobsToSQSQueue(sqs_queue, jobs: list, sqs_client=None, max_retries: int = 3):
+    sqs_client = sqs_client or _getAWSClient('sqs')
+    max_batch_bytes = 256 * 1024
+    pending = {}
+
+    for i, job in enumerate(jobs):
         job_string = json.dumps(job, ensure_ascii=False, default=str) # Send message method needs a string
-        job_md5 = hashlib.md5(str(job_string).encode()).hexdigest()
-        
-        response = sqs_client.send_message(
-            QueueUrl=sqs_queue, 
-            MessageBody=job_string
-        )
+        job_size = len(job_string.encode())
+        if job_size > max_batch_bytes:
+            print(f"Job {job['Job_ID']} is too large to be sent to SQS ({job_size} bytes)")
+            continue
+        pending[str(i)] = (job, job_string, hashlib.md5(job_string.encode()).hexdigest(), job_size)
 
-        if response.get('MD5OfMessageBody') == job_md5:
-            print("Hash corresponds")
-        else:
-            print("Hash does not correspond")
+    sent_jobs = []
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            time.sleep(min(0.1 * 2 ** attempt, 2))
 
-    except Exception as e:
-        print(f"Error sending message to SQS: {e}")
-        return
-    
-    job['Sent_to_queue'] = True
-    _updateJobInDynamoDB(_retrieveDynamoDBTable(os.getenv("DYNAMODB_TABLE_NAME")), job)
-    return
\ No newline at end of file
+        failed = {}
+        for batch in _packSQSBatches(pending, max_batch_bytes):
+            try:
+                response = sqs_client.send_message_batch(
+                    QueueUrl = sqs_queue,
+                    Entries = [{'Id': entry_id, 'MessageBody': pending[entry_id][1]} for entry_id in batch]
+                )
+            except Exception as e:
+                print(f"Error sending message batch to SQS: {e}")
+                failed.update({entry_id: pending[entry_id] for entry_id in batch})
+                continue
+
+            for entry in response.get('Successful', []):
+                job, _, job_md5, _ = pending[entry['Id']]
+                if entry.get('MD5OfMessageBody') == job_md5:
+                    job['Sent_to_queue'] = True
+                    sent_jobs.append(job)
+                else:
+                    print(f"Hash does not correspond for job {job['Job_ID']}")
+                    failed[entry['Id']] = pending[entry['Id']]
+
+            for entry in response.get('Failed', []):
+                print(f"Error sending job {pending[entry['Id']][0]['Job_ID']} to SQS: {entry.get('Message')}")
+                # Errors caused by the message itself would fail again
+                if not entry.get('SenderFault'):
+                    failed[entry['Id']] = pending[entry['Id']]
+
+        pending = failed
+
+    if pending:
+        print(f"{len(pending)} jobs not sent to SQS after {max_retries} retries")
+
+    return sent_jobs
+
+
+# Split the pending entries into batches of at most 10 entries and max_batch_bytes total body size
+def _packSQSBatches(pending: dict, max_batch_bytes: int):
+    batches = []
+    batch, batch_bytes = [], 0
+
+    for entry_id, (_, _, _, job_size) in pending.items():
+        if len(batch) == 10 or batch_bytes + job_size > max_batch_bytes:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(entry_id)
+        batch_bytes += job_size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+# Maximum number of job pages downloaded at the same time
+MAX_IN_FLIGHT_REQUESTS = int(os.getenv("MAX_IN_FLIGHT_REQUESTS", "4"))
+
+# Maximum number of requests per second sent to the same host
+REQUESTS_PER_SECOND_PER_HOST = float(os.getenv("REQUESTS_PER_SECOND_PER_HOST", "2"))
+
+# Seconds to wait for the connection and for each read from the socket
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+
+# Retries of a request that failed with a connection error, 429 or 5xx
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+
+
+# Space out the requests sent to each host, so the server does not reset the connection
+# due to too much requests in the unit of time. Shared by all the downloading threads
+class _HostRateLimiter:
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    # Block until a new request can be sent to the host of the url
+    def wait(self, url: str):
+        if not self.interval:
+            return
+
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Create the session shared by all the requests of the process. Its connection pool is sized
+# to the number of requests in flight, so connections (and TLS handshakes) are reused.
+# Failed requests are retried with exponential backoff and jitter, honoring Retry-After
+def _createHTTPSession(pool_size: int):
+    retry = Retry(
+        total = HTTP_MAX_RETRIES,
+        backoff_factor = 0.5,
+        backoff_jitter = 0.5,
+        status_forcelist = [429, 500, 502, 503, 504],
+        allowed_methods = ["GET"],
+        respect_retry_after_header = True,
+        raise_on_status = False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # gzip and deflate, plus br when brotli is installed
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return session
+
+
+_rate_limiter = _HostRateLimiter(REQUESTS_PER_SECOND_PER_HOST)
+_session = _createHTTPSession(MAX_IN_FLIGHT_REQUESTS)
+
+
+# Make an http get request to the url. Returns the response content, or None if the request failed
+def _makeHTTPRequest(url: str):
+    _rate_limiter.wait(url)
+    try:
+        response = _session.get(url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+    except requests.RequestException as e:
+        print(f"Error requesting {url}: {e}")
+        return None
+
+    if response.status_code != 200:
+        print(f"Error requesting {url}: status code {response.status_code}")
+        return None
+
+    return response.text
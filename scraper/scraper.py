@@ -1,23 +1,69 @@
 import os
+import re
 import json
 import time
+import fcntl
+import multiprocessing
 import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from bs4.element import Tag
 import dotenv
 
 import awsutils as aws_ut
+import httputils as http_ut
 
-# Make an http get request to the url. Returns the response content
-def _makeHTTPRequest(url: str):
-    response = requests.get(url)
-    return response.text
 
-# Elaborate the response using BeautifulSoup's html parser
+# Seconds a worker keeps the lease on a keyword without saving a checkpoint
+CRAWL_LEASE_SECONDS = int(os.getenv("CRAWL_LEASE_SECONDS", "300"))
+
+# Maximum number of Job_IDs remembered as already handled in this run
+SEEN_JOBS_CACHE_SIZE = int(os.getenv("SEEN_JOBS_CACHE_SIZE", "50000"))
+
+
+# Bounded set of the Job_IDs already handled by this process, forgetting the least recently seen ones
+class _SeenJobs:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.job_ids = OrderedDict()
+
+    def __contains__(self, job_id: str):
+        if job_id in self.job_ids:
+            self.job_ids.move_to_end(job_id)
+            return True
+        return False
+
+    def add(self, job_id: str):
+        self.job_ids[job_id] = None
+        self.job_ids.move_to_end(job_id)
+        if len(self.job_ids) > self.max_size:
+            self.job_ids.popitem(last=False)
+
+
+_seen_jobs = _SeenJobs(SEEN_JOBS_CACHE_SIZE)
+
+
+# Choose the parser used by BeautifulSoup: lxml (C-based) unless HTML_PARSER says otherwise.
+# Fall back to the pure-Python html.parser if lxml is not installed
+def _selectHTMLParser(parser: str):
+    if parser == "lxml":
+        try:
+            import lxml
+        except ImportError:
+            print("lxml not installed, using html.parser")
+            return "html.parser"
+    return parser
+
+
+HTML_PARSER = _selectHTMLParser(os.getenv("HTML_PARSER", "lxml"))
+
+
+# Elaborate the response using BeautifulSoup and the selected html parser
 def _organizeResponse(response: str):
-    soup = BeautifulSoup(response, "html.parser")
+    soup = BeautifulSoup(response, HTML_PARSER)
     return soup
 
 # Extract the list of job cards in the given web page    
@@ -31,55 +77,71 @@ def _extactJobIDFromHTML(job_card: Tag):
     if job_id: return job_id
     else: return ''
 
-# Use css selectors to extract the job title from the card received
-def _extractTitleFromHTML(job_card: Tag):
-    tag = job_card.select_one("a span")
-    if tag:
-        title = tag.get_text().strip()
-        if title: return title
-    else: return ''
+# Check if the tag is nested, at any depth, inside a tag with the given name
+def _hasAncestor(tag: Tag, name: str):
+    parent = tag.parent
+    while parent is not None:
+        if parent.name == name:
+            return True
+        parent = parent.parent
+    return False
 
-# Extract the company name from the card received
-def _extractCompanyNameFromHTML(job_card: Tag):
-    tag = job_card.select_one("h4 a")
-    if tag:
-        company_name = tag.get_text().strip()
-        if company_name: return company_name
-    else: return ''
+# Extract title, company name, location and pubblication date from the card received in a single traversal.
+# Each field comes from the first tag, in document order, matching the css selector used before:
+# "a span", "h4 a", "span.job-search-card__location" and "time".
+# A field is '' if its tag is missing and None if the tag is there but empty
+def _extractCardFieldsFromHTML(job_card: Tag):
+    fields = {}
 
-# Extract the location of the job from the card received
-def _extractJobLocationFromHTML(job_card: Tag):
-    tag = job_card.select_one("span.job-search-card__location")
-    if tag:
-        location = tag.get_text().strip()
-        if location: return location
-    else: return ''
+    for tag in job_card.descendants:
+        if not isinstance(tag, Tag):
+            continue
 
-# Extract the pubblication date of the job post
-def _extractPubblicationDateFromHTML(job_card: Tag):
-    tag = job_card.select_one("time")
-    if tag:
-        date = tag.get('datetime')
-        if date: return date
-    else: return ''
+        if tag.name == 'span':
+            if 'Title' not in fields and _hasAncestor(tag, 'a'):
+                fields['Title'] = tag.get_text().strip() or None
+            if 'Location' not in fields and 'job-search-card__location' in tag.get('class', []):
+                fields['Location'] = tag.get_text().strip() or None
+        elif tag.name == 'a':
+            if 'Company_name' not in fields and _hasAncestor(tag, 'h4'):
+                fields['Company_name'] = tag.get_text().strip() or None
+        elif tag.name == 'time':
+            if 'Pubblication_date' not in fields:
+                fields['Pubblication_date'] = tag.get('datetime') or None
+
+        if len(fields) == 4:
+            break
+
+    return {
+        'Title': fields.get('Title', ''),
+        'Company_name': fields.get('Company_name', ''),
+        'Location': fields.get('Location', ''),
+        'Pubblication_date': fields.get('Pubblication_date', '')
+    }
 
 # Extract the link to go to the job page
 def _goToJobPage(base_url: str, job_id: str):
     url = base_url + job_id
-    response = _makeHTTPRequest(url)
+    response = http_ut._makeHTTPRequest(url)
     return response
 
-# Extract the job description to retrieve then skills required
-# Extract text recursively from the "container tag" that contains the entire description
-def _extractJobDescriptionFronHTML(web_page: BeautifulSoup):
-    tag = web_page.select_one("div.show-more-less-html__markup")
+# Download the pages of the jobs received in parallel, keeping at most MAX_IN_FLIGHT_REQUESTS in flight
+def _fetchJobPages(base_url: str, job_ids: list):
+    with ThreadPoolExecutor(max_workers=http_ut.MAX_IN_FLIGHT_REQUESTS) as executor:
+        job_pages = list(executor.map(lambda job_id: _goToJobPage(base_url, job_id), job_ids))
+    return job_pages
+
+# Only the container of the description is built as a tree when a job page is parsed.
+# While parsing, the class attribute is still a single string, so match the class as a whole word
+_DESCRIPTION_STRAINER = SoupStrainer("div", class_=re.compile(r"(^|\s)show-more-less-html__markup(\s|$)"))
+
+# Extract the job description to retrieve then skills required.
+# Parse only the "container tag" that contains the entire description and take its text in one linear pass
+def _extractJobDescriptionFronHTML(job_page: str):
+    soup = BeautifulSoup(job_page, HTML_PARSER, parse_only=_DESCRIPTION_STRAINER)
+    tag = soup.select_one("div.show-more-less-html__markup")
     if tag:
-        description = tag.get_text().strip()
-        if description == "":
-            print("searching in child tags")
-            for child in tag.descendants:
-                description = description.join(child.get_text().strip())
-        return description
+        return tag.get_text().strip()
     else: return ''
 
 # Update the url with the number of job_posting already scraped
@@ -91,74 +153,252 @@ def _modifyUrl(url: str, new_start: int):
     new_url = parsed_url._replace(query=new_query_string).geturl()
     return new_url
 
-# Create a JSON object for each job_card received
-def _createJobObject(job_card: Tag):
+# Create a JSON object for each job_card received, using the job page already downloaded
+def _createJobObject(job_card: Tag, job_page: str):
     job = {}
     job['Job_ID'] = _extactJobIDFromHTML(job_card)
-    job['Title'] = _extractTitleFromHTML(job_card)
-    job['Company_name'] = _extractCompanyNameFromHTML(job_card)
-    job['Location'] = _extractJobLocationFromHTML(job_card)
-    job['Pubblication_date'] = _extractPubblicationDateFromHTML(job_card)
+    job.update(_extractCardFieldsFromHTML(job_card))
 
-    response = _goToJobPage(os.getenv("SINGLE_JOB_BASE_LINK"), job['Job_ID'])
-    soup = _organizeResponse(response)
- 
-    job['Description'] = _extractJobDescriptionFronHTML(soup)
+    job['Description'] = _extractJobDescriptionFronHTML(job_page or '')
     job['Sent_to_queue'] = False
 
     return job
 
-# Make a json object for each job scraped and send them to dynamoDB and SQS   
-def scrapeJobs(url: str, post_scraped: int, db_table, sqs_queue_url):
+# Load the crawl checkpoint of the keyword for the current run and take its lease.
+# Use the local file if CHECKPOINT_FILE is set, otherwise the DynamoDB crawl state table (if any).
+# Returns None if another worker is crawling the keyword
+def _loadCheckpoint(state_table, keyword: str, run_id: str, worker_id: str):
+    checkpoint = None
+    checkpoint_file = os.getenv("CHECKPOINT_FILE")
+
+    if checkpoint_file:
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, "r") as f:
+                checkpoint = json.load(f).get(keyword)
+    elif state_table is not None:
+        claimed, checkpoint = aws_ut._claimCrawlKeyword(state_table, keyword, run_id, worker_id, CRAWL_LEASE_SECONDS)
+        if not claimed:
+            return None
+
+    # A checkpoint left by a previous run must not stop today's crawl
+    if not checkpoint or checkpoint.get('Run_ID') != run_id:
+        checkpoint = {}
+
+    return {
+        'Keyword': keyword,
+        'Run_ID': run_id,
+        'Start': int(checkpoint.get('Start', 0)),
+        'Done': bool(checkpoint.get('Done', False)),
+        'Owner': worker_id
+    }
+
+# Persist the crawl checkpoint of a keyword, so a restarted task resumes from it.
+# Returns False if the worker lost the lease on the keyword and has to stop crawling it
+def _saveCheckpoint(state_table, checkpoint: dict):
+    checkpoint_file = os.getenv("CHECKPOINT_FILE")
+
+    if checkpoint_file:
+        # The worker processes share the file: the lock keeps each one from dropping the keywords of the others
+        with open(checkpoint_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            checkpoints = {}
+            if os.path.exists(checkpoint_file):
+                with open(checkpoint_file, "r") as f:
+                    checkpoints = json.load(f)
+            checkpoints[checkpoint['Keyword']] = checkpoint
+
+            # Write to a temporary file of the process first, so a crash never leaves a truncated checkpoint
+            tmp_file = f"{checkpoint_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(checkpoints, f)
+            os.replace(tmp_file, checkpoint_file)
+
+    elif state_table is not None:
+        checkpoint['Lease_expires'] = int(time.time()) + CRAWL_LEASE_SECONDS
+        return aws_ut._saveCrawlCheckpoint(state_table, checkpoint)
+
+    return True
+
+# Make a json object for each job in the results page, send them to SQS and add the ones to save in dynamoDB
+# to jobs_to_save. Returns the number of job cards found in the page, or None if the page could not be downloaded
+def scrapeJobs(url: str, db_table, sqs_queue_url, jobs_to_save: list):
     print(url) 
-    response = _makeHTTPRequest(url)
+    response = http_ut._makeHTTPRequest(url)
+    if response is None:
+        return None
+
     soup = _organizeResponse(response)
     job_cards = _extractJobCardsFromHTML(soup)
     jobs_retrieved = len(job_cards)
-    
+
+    # Stage 1: parse the cards, skipping the jobs already handled in this run
+    # (LinkedIn repeats the same postings across keywords)
+    new_cards = {}
     for card in job_cards:
-        job = _createJobObject(card)
+        job_id = _extactJobIDFromHTML(card)
+        if job_id not in _seen_jobs and job_id not in new_cards:
+            new_cards[job_id] = card
+
+    if not new_cards:
+        return jobs_retrieved
+
+    # Stage 2: look up all the remaining jobs in DynamoDB at once
+    stored_jobs = aws_ut._checkIfJobsExist(db_table, list(new_cards)) # The response is a dict of jobs, by Job_ID
+
+    # Stage 3: download the job page only for new jobs and jobs not yet sent to the queue
+    cards_to_fetch = {}
+    for job_id, card in new_cards.items():
+        _seen_jobs.add(job_id)
+        result_job = stored_jobs.get(job_id)
+        if result_job is None or not result_job['Sent_to_queue']:
+            cards_to_fetch[job_id] = card
+
+    if not cards_to_fetch:
+        return jobs_retrieved
+
+    job_pages = _fetchJobPages(os.getenv("SINGLE_JOB_BASE_LINK"), list(cards_to_fetch))
+
+    # Stage 4: send the jobs with a description to SQS and save them to DynamoDB
+    new_jobs = []
+    jobs_to_send = []
+    
+    for card, job_page in zip(cards_to_fetch.values(), job_pages):
+        job = _createJobObject(card, job_page)
+
+        if job['Job_ID'] not in stored_jobs:
+            new_jobs.append(job)
+        if job['Description'] != '':
+            jobs_to_send.append(job)
+
+    sent_jobs = aws_ut._writeJobsToSQSQueue(sqs_queue_url, jobs_to_send)
+
+    # Jobs are written once, already in their final Sent_to_queue state
+    jobs_to_save.extend(new_jobs + [job for job in sent_jobs if job['Job_ID'] in stored_jobs])
+
+    return jobs_retrieved
+
+# Save the buffered jobs to DynamoDB, in full batches of 25 items unless all of them are requested
+def _flushJobs(db_table, jobs_to_save: list, all_jobs: bool = False):
+    count = len(jobs_to_save) if all_jobs else len(jobs_to_save) - len(jobs_to_save) % 25
+    if count > 0:
+        aws_ut._saveJobsToDynamoDB(db_table, jobs_to_save[:count])
+        del jobs_to_save[:count]
+
+# Scrape all the results pages of the keyword, one page at a time, starting from its checkpoint.
+# The checkpoint is saved after every page, so only the page in progress is redone after a restart.
+# Jobs to save are buffered across pages and flushed 25 at a time, and at the end of the keyword.
+# Returns False if the keyword is leased by another worker and has to be retried later
+def crawlKeyword(keyword: str, db_table, sqs_queue_url, state_table, run_id: str, worker_id: str):
+    checkpoint = _loadCheckpoint(state_table, keyword, run_id, worker_id)
+    if checkpoint is None:
+        print(f"Keyword {keyword} is being crawled by another worker")
+        return False
+    if checkpoint['Done']:
+        print(f"Keyword {keyword} already crawled in run {run_id}")
+        return True
+
+    start_url = f"https://www.linkedin.com/jobs-guest/jobs/api/seeMoreJobPostings/search?keywords={keyword}&geoId=103350119&start=0"
+    jobs_to_save = []
+
+    try:
+        while not checkpoint['Done']:
+            url = _modifyUrl(start_url, checkpoint['Start'])
+            jobs_retrieved = scrapeJobs(url, db_table, sqs_queue_url, jobs_to_save)
 
-        result_job = aws_ut._checkIfJobExists(db_table, job['Job_ID']) # The response is a dict of jobs
+            # The checkpoint stays on the failed page, so the next attempt resumes from it
+            if jobs_retrieved is None:
+                print(f"Stopping crawl of keyword {keyword} at start={checkpoint['Start']}")
+                return True
 
-        if result_job is None:
-            aws_ut._saveJobToDynamoDB(db_table, job)
-            if job['Description'] != '':
-                aws_ut._writeJobToSQSQueue(sqs_queue_url, job)
+            _flushJobs(db_table, jobs_to_save)
 
-        else:
-            if result_job['Sent_to_queue']:
-                continue
+            if jobs_retrieved > 0:
+                checkpoint['Start'] += jobs_retrieved
             else:
-                if job['Description'] != '':
-                    aws_ut._writeJobToSQSQueue(sqs_queue_url, job)
-                    
-        
-    if jobs_retrieved > 0:
-        post_scraped += jobs_retrieved
-        new_url = _modifyUrl(url, post_scraped)
-        
-        #To not make the server reset the connection due to too much requests in the unit of time
-        time.sleep(1)
+                checkpoint['Done'] = True
 
-        scrapeJobs(new_url, post_scraped, db_table, sqs_queue_url)
+            if not _saveCheckpoint(state_table, checkpoint):
+                print(f"Lease on keyword {keyword} lost, another worker took it over")
+                return True
+
+    finally:
+        _flushJobs(db_table, jobs_to_save, all_jobs=True)
+
+    return True
+
+# Take the keywords assigned to the worker: every shard_count-th keyword starting from shard_index
+def _selectShard(keywords: list, shard_index: int, shard_count: int):
+    return keywords[shard_index::shard_count]
+
+# Crawl the keywords received. Each worker process has its own AWS resources and its own rate limiter,
+# allowed requests_per_second requests per second to each host
+def _runWorker(keywords: list, run_id: str, worker_id: str, requests_per_second: float):
+    http_ut._rate_limiter = http_ut._HostRateLimiter(requests_per_second)
+    db_table = aws_ut._retrieveDynamoDBTable(os.getenv("DYNAMODB_TABLE_NAME"))    
+    sqs_queue_url = aws_ut._retrieveSQSQueueUrl(os.getenv("DEDUPLICATED_JOBS_QUEUE_NAME"))
+
+    state_table = None
+    if os.getenv("CRAWL_STATE_TABLE_NAME"):
+        state_table = aws_ut._retrieveDynamoDBTable(os.getenv("CRAWL_STATE_TABLE_NAME"))
+
+    print(f"Worker {worker_id} crawling keywords: {keywords}")
+
+    # Keywords leased by another worker go back in the queue and are retried once that lease has expired:
+    # if its owner died, the keyword is taken over, otherwise its checkpoint is found done.
+    # Retry times only grow, so the queue stays ordered by them
+    pending = deque((k, 0.0) for k in keywords)
+    while pending:
+        keyword, retry_at = pending.popleft()
+        wait = retry_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        if not crawlKeyword(keyword, db_table, sqs_queue_url, state_table, run_id, worker_id):
+            pending.append((keyword, time.monotonic() + CRAWL_LEASE_SECONDS + 1))
 
 
 def main():
     dotenv.load_dotenv()
 
     aws_ut._setupAWSSession()
-    db_table = aws_ut._retrieveDynamoDBTable(os.getenv("DYNAMODB_TABLE_NAME"))    
-    sqs_queue_url = aws_ut._retrieveSQSQueueUrl(os.getenv("DEDUPLICATED_JOBS_QUEUE_NAME"))
 
-    keywords = [ 'Mobile+Developer', 'Game+Design', 'Backend+Developer', 'Frontend+Developer', 'Software+Engineer', 'Software+Engineer', 'Fullstack+Developer',
+    # Checkpoints are valid only inside the same run: by default a run lasts one day
+    run_id = os.getenv("CRAWL_RUN_ID") or time.strftime("%Y-%m-%d", time.gmtime())
+
+    keywords = [ 'Mobile+Developer', 'Game+Design', 'Backend+Developer', 'Frontend+Developer', 'Software+Engineer', 'Fullstack+Developer',
                 'Data+Analyst', 'Data+Scientist', 'Cloud+Engineer', 'Devops', 'Artificial+Intelligence', 'Python+Developer',
                 'Game+Developer', 'Unity+Developer', 'Unreal+Engine+Developer',]
+    keywords = list(dict.fromkeys(keywords))
+
+    # Each task takes the shard SHARD_INDEX of SHARD_COUNT and splits it among its WORKER_PROCESSES.
+    # Tasks started with the same shard share the keywords through the leases of the crawl state table.
+    # Worker ids must survive a restart, so the new task owns the leases of the old one and resumes
+    # its checkpoints: they come from WORKER_ID (distinct for tasks sharing a shard) or from the shard
+    shard_index = int(os.getenv("SHARD_INDEX", "0"))
+    shard_count = int(os.getenv("SHARD_COUNT", "1"))
+    worker_processes = int(os.getenv("WORKER_PROCESSES", "1"))
+    task_id = os.getenv("WORKER_ID") or f"shard-{shard_index}"
+
+    task_keywords = _selectShard(keywords, shard_index, shard_count)
+
+    if worker_processes <= 1:
+        _runWorker(task_keywords, run_id, task_id, http_ut.REQUESTS_PER_SECOND_PER_HOST)
+        return
+
+    # The workers share the request budget of the task, so the rate to each host does not grow with them
+    worker_requests_per_second = http_ut.REQUESTS_PER_SECOND_PER_HOST / worker_processes
+
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for i in range(worker_processes):
+        worker_keywords = _selectShard(task_keywords, i, worker_processes)
+        worker = context.Process(target=_runWorker, args=(worker_keywords, run_id, f"{task_id}-{i}", worker_requests_per_second))
+        worker.start()
+        workers.append(worker)
 
-    for k in keywords:
-        start_url = f"https://www.linkedin.com/jobs-guest/jobs/api/seeMoreJobPostings/search?keywords={k}&geoId=103350119&start=0"
-        post_scraped = 0
-        scrapeJobs(start_url, post_scraped, db_table, sqs_queue_url)
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-north-1")
+
+import scraper
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def _readFixture(name: str):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+# The job objects built from the fixtures must match the ones of the original extractors
+# (expected_jobs.json, produced by the per-field select_one extractors with html.parser) with both parsers
+class TestExtractors(unittest.TestCase):
+
+    def setUp(self):
+        self.results_page = _readFixture("job_cards.html")
+        self.job_pages = {"4012345678": _readFixture("job_page.html")}
+        self.closed_page = "<html><body><p>Job closed</p></body></html>"
+        self.expected_jobs = json.loads(_readFixture("expected_jobs.json"))
+
+    def _createJobs(self):
+        job_cards = scraper._extractJobCardsFromHTML(scraper._organizeResponse(self.results_page))
+        job_ids = [scraper._extactJobIDFromHTML(job_card) for job_card in job_cards]
+        return [
+            scraper._createJobObject(job_card, self.job_pages.get(job_id, self.closed_page))
+            for job_card, job_id in zip(job_cards, job_ids)
+        ]
+
+    def test_job_objects_match_original_extractors(self):
+        for parser in ("lxml", "html.parser"):
+            with self.subTest(parser=parser), mock.patch.object(scraper, "HTML_PARSER", parser):
+                self.assertEqual(self._createJobs(), self.expected_jobs)
+
+    def test_empty_and_missing_fields(self):
+        for parser in ("lxml", "html.parser"):
+            with self.subTest(parser=parser), mock.patch.object(scraper, "HTML_PARSER", parser):
+                jobs = self._createJobs()
+                # Tags present but empty
+                self.assertIsNone(jobs[1]["Title"])
+                self.assertIsNone(jobs[1]["Pubblication_date"])
+                # Tags missing
+                self.assertEqual(jobs[2]["Company_name"], "")
+                self.assertEqual(jobs[2]["Location"], "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,14 +16,27 @@ let selectedTokens = new Set();
 const API_BASE_URL = `https://${CONFIG.API_ID}.execute-api.${CONFIG.AWS_REGION}.amazonaws.com/prod`
 const API_ENDPOINTS = {
     fetchJobs: `${API_BASE_URL}/Job-Posts`,
-    saveJobs: `${API_BASE_URL}/Job-Posts`
+    saveJobs: `${API_BASE_URL}/Job-Posts`,
+    leases: `${API_BASE_URL}/Job-Posts/Leases`
 };
 
+// Number of job posts asked for each time the list is loaded (at most 50)
+const JOBS_PER_FETCH = 20;
+
+// Most job posts saved in a single request
+const MAX_JOBS_PER_SUBMISSION = 50;
+
+// Job posts are checked out with a 15 minutes lease, renewed every 5 minutes while they are in the list
+const LEASE_RENEWAL_INTERVAL_MS = 5 * 60 * 1000;
+
 // Initialize the application
 document.addEventListener('DOMContentLoaded', function () {
     setupEventListeners();
     loadJobPosts();
     renderLabelsList();
+    setInterval(renewJobLeases, LEASE_RENEWAL_INTERVAL_MS);
+    // Give the jobs back to the queue when the page is closed
+    window.addEventListener('pagehide', () => releaseJobLeases(currentJobPosts));
 });
 
 function setupEventListeners() {
@@ -272,18 +285,23 @@ async function loadJobPosts() {
     try {
         updateStatus('Loading job posts...');
 
-        const response = await fetch(API_ENDPOINTS.fetchJobs);
+        const response = await fetch(`${API_ENDPOINTS.fetchJobs}?count=${JOBS_PER_FETCH}`);
         const data = await response.json();
 
         const newJobs = data.jobs.map(job => ({
             id: job.Job_ID,
             title: job.Title,
             company: job.Company,
-            tokens: job.Tokens
+            tokens: job.Tokens.map((text, i) => ({ id: i, text: text, label: '', position: i })),
+            leaseId: job.Lease_ID
         }))
 
-        const existingJobIds = currentJobPosts.map(job => job.id);
-        const newJobsToAdd = newJobs.filter(job => !existingJobIds.includes(job.id));
+        // A job already in the list comes back only after its lease expired: keep its labels and take the new lease
+        const existingJobs = new Map(currentJobPosts.map(job => [job.id, job]));
+        newJobs.filter(job => existingJobs.has(job.id)).forEach(job => {
+            existingJobs.get(job.id).leaseId = job.leaseId;
+        });
+        const newJobsToAdd = newJobs.filter(job => !existingJobs.has(job.id));
 
         currentJobPosts.push(...newJobsToAdd);
         renderJobList();
@@ -294,7 +312,55 @@ async function loadJobPosts() {
     }
 }
 
+// Send the leases of the jobs to the leases endpoint with the given method
+function sendJobLeases(method, jobs) {
+    return fetch(API_ENDPOINTS.leases, {
+        method: method,
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            leases: jobs.map(job => ({ jobId: job.id, leaseId: job.leaseId }))
+        }),
+        keepalive: true
+    });
+}
+
+// Extend the leases of the jobs in the list. Jobs whose lease expired went back to the queue and are removed
+async function renewJobLeases() {
+    if (currentJobPosts.length === 0) {
+        return;
+    }
+
+    try {
+        const response = await sendJobLeases('PUT', currentJobPosts);
+        const data = await response.json();
+
+        if (data.lost && data.lost.length > 0) {
+            const lostJobIds = new Set(data.lost);
+            currentJobPosts = currentJobPosts.filter(job => !lostJobIds.has(job.id));
+            if (currentSelectedJob && lostJobIds.has(currentSelectedJob.id)) {
+                currentSelectedJob = null;
+            }
+            renderJobList();
+            updateStatus(`${data.lost.length} job post(s) expired and went back to the queue`);
+        }
+    } catch (error) {
+        console.error('Failed to renew job leases:', error);
+    }
+}
+
+// Give the jobs back to the queue, so other annotators can label them
+function releaseJobLeases(jobs) {
+    if (jobs.length === 0) {
+        return;
+    }
+
+    sendJobLeases('DELETE', jobs).catch(error => console.error('Failed to release job leases:', error));
+}
+
 function clearAllJobPosts() {
+    releaseJobLeases(currentJobPosts);
     currentJobPosts = [];
     currentSelectedJob = null;
     deletionHistory = [];
@@ -488,6 +554,7 @@ async function saveLabels() {
         const labeledTokens = createLabeledTokensList(currentSelectedJob.tokens);
         const payload = {
             jobId: currentSelectedJob.id,
+            leaseId: currentSelectedJob.leaseId,
             title: currentSelectedJob.title,
             tokens: labeledTokens,
             totalTokens: labeledTokens.length,
@@ -501,6 +568,10 @@ async function saveLabels() {
             body: JSON.stringify(payload)
         });
 
+        if (!response.ok && response.status !== 409) {
+            throw new Error(`Save failed with status ${response.status}`);
+        }
+
         // Delete job from the left column list
         currentJobPosts = currentJobPosts.filter(job => job.id !== currentSelectedJob.id);
         currentSelectedJob = null;
@@ -518,7 +589,80 @@ async function saveLabels() {
         `;
 
         console.log('Would save:', payload);
-        updateStatus('Labels saved successfully');          
+        if (response.status === 409) {
+            updateStatus('The job post expired and was checked out by another annotator, labels not saved');
+        } else {
+            updateStatus('Labels saved successfully');
+        }          
+    } catch (error) {
+        console.error('Failed to save labels:', error);
+        updateStatus('Error saving labels');
+    }
+}
+
+// Save in one request every job post with at least one labeled token, and remove the saved ones from the list
+async function saveAllLabels() {
+    const labeledJobs = currentJobPosts
+        .filter(job => job.tokens.some(token => token.label && token.label !== 'Unlabeled'))
+        .slice(0, MAX_JOBS_PER_SUBMISSION);
+
+    if (labeledJobs.length === 0) {
+        alert('No labeled job posts to save');
+        return;
+    }
+
+    if (!confirm(`Are you sure you want to save the labels of ${labeledJobs.length} job post(s)? Once saved, they will be removed from the list.`)) {
+        return;
+    }
+
+    try {
+        updateStatus('Saving labels...');
+
+        const jobs = labeledJobs.map(job => {
+            const labeledTokens = createLabeledTokensList(job.tokens);
+            return {
+                jobId: job.id,
+                leaseId: job.leaseId,
+                title: job.title,
+                tokens: labeledTokens,
+                totalTokens: labeledTokens.length,
+            };
+        });
+
+        const response = await fetch(API_ENDPOINTS.saveJobs, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ jobs: jobs })
+        });
+        if (!response.ok) {
+            throw new Error(`Save failed with status ${response.status}`);
+        }
+        const data = await response.json();
+
+        // Saved jobs and jobs checked out by another annotator leave the list, failed ones stay to be retried
+        const doneJobIds = new Set(data.results
+            .filter(result => result.status === 'saved' || result.status === 'conflict')
+            .map(result => result.jobId));
+        const failed = data.results.length - doneJobIds.size;
+
+        currentJobPosts = currentJobPosts.filter(job => !doneJobIds.has(job.id));
+        if (currentSelectedJob && doneJobIds.has(currentSelectedJob.id)) {
+            currentSelectedJob = null;
+            deletionHistory = [];
+            const editorTitle = document.getElementById('editor-title');
+            const editorContent = document.getElementById('editor-content');
+            editorTitle.textContent = 'Select a job post to start labeling';
+            editorContent.innerHTML = `
+        <div class="no-selection">
+            <p>Select a job post from the left panel to begin labeling.</p>
+        </div>
+        `;
+        }
+        renderJobList();
+
+        updateStatus(`Saved ${data.saved} job post(s)` + (failed > 0 ? `, ${failed} failed` : ''));
     } catch (error) {
         console.error('Failed to save labels:', error);
         updateStatus('Error saving labels');